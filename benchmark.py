@@ -0,0 +1,349 @@
+'''
+Offline benchmarks for the dashboard's refresh pipeline and page serving.
+
+Cov19API and NewsAPI are replaced by synthetic payloads of several sizes,
+and the app runs in a temporary directory with its own copy of the
+configuration, so no network access or API key is needed. Results are
+written as JSON so runs can be compared to catch regressions.
+
+    python benchmark.py                     # full sizes, results to stdout
+    python benchmark.py --quick -o out.json # small sizes, results to a file
+    python benchmark.py --filter parse      # only benchmarks matching "parse"
+'''
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta, timezone
+
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# (areas, days) of statistics and numbers of articles to run at
+SIZES = {
+    'areas': [(1, 600), (30, 1000), (300, 1000)],
+    'articles': [10, 1000, 10000],
+    'schedules': [10, 100, 1000],
+}
+QUICK_SIZES = {
+    'areas': [(1, 600), (30, 600)],
+    'articles': [10, 1000],
+    'schedules': [10, 100],
+}
+
+# overrides applied to the copy of covid_config.cfg used by the benchmarks
+BENCH_CONFIG = {
+    'apiKey': "benchmark",
+    'location': "Area 0",
+    'nation': "England",
+    'areas': [],
+    'newsCSV': "news.csv",
+    'newsPersist': False,
+    'covidCSVSnapshot': False,
+    'statsSnapshot': "",
+    'newsSnapshot': "",
+    'removalFlushDelay': 3600,
+    'logLevel': "WARNING",
+    'logLevels': {},
+}
+
+
+def covid_rows(area: str, days: int, seed: int = 0) -> list:
+    '''
+        Synthetic rows in the layout returned by Cov19API, most recent first,
+        with the blanks the real API has for the latest days
+    '''
+    rand = random.Random(seed)
+    latest = date.today() - timedelta(days=1)
+    rows = []
+    for day in range(days):
+        rows.append({
+            'areaCode': "E%08d" % seed,
+            'areaName': area,
+            'areaType': "ltla",
+            'date': (latest - timedelta(days=day)).isoformat(),
+            'cumDailyNsoDeathsByDeathDate': None if day < 10 else 150000 - day * 40,
+            'hospitalCases': None if day < 2 else rand.randint(100, 9000),
+            'newCasesBySpecimenDate': None if day < 1 else rand.randint(0, 50000),
+        })
+    return rows
+
+
+def news_articles(count: int, seed: int = 0) -> list:
+    '''
+        Synthetic articles in the layout returned by NewsAPI, newest first
+    '''
+    rand = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    return [{
+        'source': {'id': None, 'name': "Source %s" % (i % 50)},
+        'author': "Author %s" % (i % 200),
+        'title': "Covid headline %s" % i,
+        'description': "Description of article %s " % i * 3,
+        'url': "https://news.example/%s/%s" % (seed, i),
+        'urlToImage': "https://news.example/%s.jpg" % i,
+        'publishedAt': (now - timedelta(seconds=10 * i + rand.random())).strftime(
+            '%Y-%m-%dT%H:%M:%SZ'),
+        'content': "Content of article %s " % i * 10,
+    } for i in range(count)]
+
+
+class FakeCov19API:
+    '''
+        Stands in for uk_covid19.Cov19API, serving the rows in FakeCov19API.areas
+    '''
+    endpoint = "http://fake-cov19api/v1/data"
+    areas = {}
+    days = 600
+    last_update = "2021-10-28T15:00:00.000000Z"
+
+    def __init__(self, filters: list, structure: dict) -> None:
+        self.filters = dict(each.split('=', 1) for each in filters)
+
+    def get_json(self) -> dict:
+        area = self.filters['areaName']
+        rows = self.areas.get(area)
+        if rows is None:
+            rows = self.areas[area] = covid_rows(area, self.days, len(self.areas))
+        if 'date' in self.filters:
+            rows = [row for row in rows if row['date'] == self.filters['date']]
+        return {'data': rows, 'lastUpdate': self.last_update}
+
+
+class FakeResponse:
+    status_code = 200
+    headers = {}
+
+    def __init__(self, articles: list) -> None:
+        self.articles = articles
+
+    def json(self) -> dict:
+        return {'status': "ok", 'totalResults': len(self.articles), 'articles': self.articles}
+
+    def raise_for_status(self) -> None:
+        pass
+
+
+class FakeNewsSession:
+    '''
+        Stands in for the requests session used to call NewsAPI
+    '''
+
+    def __init__(self, count: int) -> None:
+        self.articles = news_articles(count)
+
+    def get(self, url: str, headers: dict = None, timeout: tuple = None) -> FakeResponse:
+        return FakeResponse(self.articles)
+
+
+def measure(function, repeat: int) -> dict:
+    '''
+        Runs function repeat times and summarises the run times in seconds
+    '''
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - started)
+    return {'runs': repeat, 'best_s': min(times), 'median_s': statistics.median(times),
+        'mean_s': statistics.fmean(times)}
+
+
+class Suite:
+    '''
+        Runs the benchmarks and collects their results
+    '''
+
+    def __init__(self, sizes: dict, repeat: int, name_filter: str = None) -> None:
+        self.sizes = sizes
+        self.repeat = repeat
+        self.name_filter = name_filter
+        self.results = []
+
+    def bench(self, name: str, params: dict, function, repeat: int = None,
+            setup=None) -> None:
+        if self.name_filter and self.name_filter not in name:
+            return
+        if setup is not None:
+            setup()
+        result = {'benchmark': name, 'params': params}
+        result.update(measure(function, repeat or self.repeat))
+        self.results.append(result)
+        print("%-28s %-32s median %9.3f ms" % (name, json.dumps(params),
+            result['median_s'] * 1000), file=sys.stderr)
+
+    def run(self) -> list:
+        import covid_data_handler
+        import covid_news_handling
+        import covid_settings
+        import main
+
+        covid_data_handler.Cov19API = FakeCov19API
+        self.bench_statistics(covid_data_handler, covid_settings)
+        self.bench_news(covid_news_handling, covid_settings)
+        self.bench_schedules(covid_data_handler, covid_news_handling)
+        self.bench_pages(main, covid_data_handler, covid_news_handling)
+        return self.results
+
+    def bench_statistics(self, handler, settings) -> None:
+        for areas, days in self.sizes['areas']:
+            params = {'areas': areas, 'days': days}
+            names = ["Area %s" % i for i in range(areas)]
+            FakeCov19API.days = days
+            FakeCov19API.areas = {name: covid_rows(name, days, i) for i, name in enumerate(names)}
+
+            # each area as the JSON payload and as the CSV the API can save
+            payloads = {name: {'data': rows} for name, rows in FakeCov19API.areas.items()}
+            for name, rows in FakeCov19API.areas.items():
+                with open(name + ".csv", 'w', newline='') as csv_file:
+                    writer = csv.DictWriter(csv_file, fieldnames=list(rows[0]))
+                    writer.writeheader()
+                    writer.writerows(rows)
+
+            self.bench('parse_json', params, lambda: [handler.CovidSeries.from_json(payload)
+                for payload in payloads.values()])
+            self.bench('parse_csv_data', params, lambda: [handler.parse_csv_data(name + ".csv")
+                for name in names])
+
+            series = {name: handler.CovidSeries.from_json(payload)
+                for name, payload in payloads.items()}
+            self.bench('process_covid_data', params, lambda: [handler.process_covid_data(each)
+                for each in series.values()])
+            self.bench('process_covid_batch', params, lambda: handler.process_covid_batch(series))
+
+            settings.override_settings(incremental_sync=False)
+            self.bench('refresh_areas', params, lambda: handler.refresh_areas(names),
+                repeat=max(1, self.repeat // 2))
+            settings.override_settings(incremental_sync=True)
+            # the first sync downloads everything, later ones only check for updates
+            handler.refresh_areas(names)
+            self.bench('refresh_areas_incremental', params,
+                lambda: handler.refresh_areas(names))
+
+            for name in names:
+                os.remove(name + ".csv")
+            # stores are saved in the background, finish before the work dir goes
+            for writer in list(handler.covid_store_writers.values()):
+                writer.flush()
+
+    def bench_news(self, news, settings) -> None:
+        # the page benchmarks use the store main imported
+        original_store = news.news_store
+        window_size = settings.get_settings().news_window_size
+        for count in self.sizes['articles']:
+            params = {'articles': count}
+            session = FakeNewsSession(count)
+            news.news_session = session
+            settings.override_settings(news_window_size=count)
+            articles = [news.Article.from_json(each) for each in session.articles]
+
+            news.write_news_csv(articles)
+            self.bench('parse_news_csv', params, news.parse_news_csv)
+
+            def fresh_store():
+                news.news_store = news.ArticleStore()
+                news.news_cache.clear()
+                news.news_refreshed_at = None
+            self.bench('news_API_request', params, lambda: (fresh_store(),
+                news.news_API_request(refresh=True)))
+            self.bench('news_window', params, news.news_store.window)
+
+            # dismiss a burst of a tenth of the window
+            titles = [article.title for article in articles[::10]]
+            self.bench('remove_article_burst', params,
+                lambda: [news.remove_article(title) for title in titles],
+                setup=lambda: (fresh_store(), news.news_store.add(articles),
+                    news.exclude_list.clear()), repeat=1)
+        news.exclude_list.clear()
+        settings.override_settings(news_window_size=window_size)
+        news.news_store = original_store
+        news.news_cache.clear()
+        news.news_refreshed_at = None
+
+    def bench_schedules(self, handler, news) -> None:
+        for count in self.sizes['schedules']:
+            params = {'schedules': count}
+            updates = []
+            for i in range(count):
+                name = "bench update %s" % i
+                # far enough ahead that none of them run during the benchmark
+                update_time = (datetime.now() + timedelta(hours=12)).strftime('%H:%M')
+                handler.schedule_covid_updates(update_time, name)
+                news.schedule_news_updates(update_time, name)
+                updates.append({'title': name, 'content': update_time})
+
+            self.bench('check_updates', params, lambda: (handler.check_covid_updates(updates),
+                news.check_news_updates(updates)))
+            for update in updates:
+                handler.remove_task(update['title'])
+
+    def bench_pages(self, main, handler, news) -> None:
+        count = self.sizes['articles'][0]
+        news.news_session = FakeNewsSession(count)
+        FakeCov19API.days = self.sizes['areas'][0][1]
+        # pages are measured with the background services running, as when served
+        main.start_services()
+        client = main.app.test_client()
+        for path in ('/', '/index'):
+            params = {'path': path, 'articles': count}
+            client.get(path)
+            self.bench('page_cached', params, lambda: client.get(path))
+            self.bench('page_render', params, lambda: (main.page_cache.clear(), client.get(path)))
+        params = {'path': '/api/news', 'articles': count}
+        self.bench('api_json', params, lambda: client.get('/api/news'))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--quick', action='store_true', help="run at the small sizes only")
+    parser.add_argument('--repeat', type=int, default=5, help="runs per benchmark")
+    parser.add_argument('--filter', help="only run benchmarks whose name contains this")
+    parser.add_argument('-o', '--output', help="file to write the JSON results to")
+    args = parser.parse_args()
+
+    # the app reads its configuration and writes its stores in the working directory
+    work_dir = tempfile.mkdtemp(prefix="covid-bench-")
+    with open(os.path.join(REPO_DIR, 'covid_config.cfg')) as config_file:
+        config = json.load(config_file)
+    config.update(BENCH_CONFIG)
+    with open(os.path.join(work_dir, 'covid_config.cfg'), 'w') as config_file:
+        json.dump(config, config_file, indent=4)
+    # relative paths given on the command line, e.g. --output, stay relative to here
+    start_dir = os.getcwd()
+    os.chdir(work_dir)
+    sys.path.insert(0, REPO_DIR)
+
+    suite = Suite(QUICK_SIZES if args.quick else SIZES, args.repeat, args.filter)
+    try:
+        results = suite.run()
+    finally:
+        os.chdir(start_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'date': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'quick': args.quick,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,19 +5,25 @@ This module contains functions to retrieve and handle COVID-19 statistics
 import logging
 import csv
 import json
+import hashlib
 import time
-import sys
 import traceback
-from datetime import datetime
+from array import array
+from datetime import date, timedelta
 import threading
-from uk_covid19 import Cov19API
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from uk_covid19 import Cov19API, api_interface
+from covid_logging import setup_logging
+from covid_settings import Settings, add_reload_listener, get_settings
+from covid_metrics import timed, cache_result
+from covid_scheduler import INTERNAL_GROUP, DailyAt, scheduler
+from covid_snapshot import SnapshotWriter, read_snapshot
 
 
 log = logging.getLogger(__name__)
-FORMAT= '%(levelname)s: %(asctime)s %(message)s'
-logging.basicConfig(format=FORMAT, stream=sys.stdout, level=logging.DEBUG)
-
-config_file = 'covid_config.cfg'
+setup_logging()
 
 global glocation
 glocation = "Exeter"
@@ -25,10 +31,6 @@ global glocation_type
 glocation_type = "ltla"
 global exclude_list
 exclude_list = []
-global config_location
-config_location = "set_in_config"
-global config_nation
-config_nation = "set_in_config"
 global sched_covid
 sched_covid = []
 global sched_news
@@ -37,51 +39,210 @@ global loop
 loop = True
 global threads
 threads = []
-global covid_sched_list
-covid_sched_list = []
 
-def read_config() -> None:
+# local per-area stores used by incremental sync, keyed by (location, location_type)
+covid_stores = {}
+# held while a store's series is changed or saved
+covid_store_lock = threading.Lock()
+# background writers saving each store, keyed the same way as covid_stores
+covid_store_writers = {}
+
+# in-process statistics cache, keyed by (location, location_type)
+stats_cache = {}
+stats_cache_lock = threading.Lock()
+# refreshes currently in progress, keyed the same way as stats_cache
+stats_inflight = {}
+# bumped whenever any cached statistics change
+stats_version = 0
+
+def apply_endpoint(settings: Settings) -> None:
     '''
-        Open config file to read contents
+        Points Cov19API at cov19Endpoint if it is set, e.g. a local
+        stand-in for load tests, see fake_upstreams.py
     '''
-    global config_location
-    global config_nation
+    Cov19API.endpoint = settings.cov19_endpoint or COV19_ENDPOINT
 
-    try:
-        with open(config_file, 'r') as json_file:
-            # Get the necessary data from the configuraton file
-            json_data = json.loads(json_file.read())
-            config_location = json_data['location']
-            config_nation = json_data['nation']
-            logging.debug('Successfully read configuration file')
-    except IOError:
-        # Catch an IOError exception
-        logging.error('Problem opening %s, ' +
-                'check to make sure your configuration file is not missing.', config_file)
-        exit()
+# the real API, used when cov19Endpoint isn't set
+COV19_ENDPOINT = Cov19API.endpoint
+apply_endpoint(get_settings())
 
-read_config()
+# connect and read timeouts for each ukcovid19 API request, so a hung
+# connection can't hold a refresh (and everyone waiting on it) forever
+COV19API_TIMEOUT = (3.05, 30)
+# longest a caller waits on another caller's refresh of the same location
+REFRESH_WAIT_TIMEOUT = 60
 
-def parse_csv_data(csv_filename: str) -> dict:
+def cov19api_request(method: str, url: str, **kwargs) -> requests.Response:
     '''
-        Takes filename as argument, opens and reads the csv file,
-        returns file content as a dictionary
+        Stands in for requests.request in uk_covid19, which doesn't
+        pass a timeout, adding COV19API_TIMEOUT to every request
     '''
-    # open csv file in read mode
-    logging.debug("Opening %s for reading", csv_filename)
-    reader = csv.DictReader(open(csv_filename, "r"))
+    kwargs.setdefault('timeout', COV19API_TIMEOUT)
+    return requests.request(method, url, **kwargs)
+
+api_interface.request = cov19api_request
 
-    # initialize dict and index
-    big_dict = {}
-    index = 0
+# every fetch from the ukcovid19 API shares this limit on concurrent requests
+api_quota = threading.BoundedSemaphore(get_settings().max_api_requests)
 
-    # loop through the csv.DictReader
-    for index, i in enumerate(reader):
-        # assign each row to a big_dict to create a dictionary of dictionaries
-        big_dict[index] = i
-    logging.debug("Successfully read from %s into dictionary", csv_filename)
+# metric columns requested from the API, kept as typed arrays by CovidSeries
+METRIC_COLUMNS = ('newCasesBySpecimenDate', 'hospitalCases', 'cumDailyNsoDeathsByDeathDate')
 
-    return big_dict
+
+class CovidSeries:
+    '''
+        Columnar COVID 19 statistics for a single area. Rows are kept in the
+        order the API returns them (most recent first), dates are stored as
+        ordinals and every metric column is a typed array with a matching
+        mask marking which values are present
+    '''
+
+    __slots__ = ('area_name', 'dates', 'columns', 'masks')
+
+    def __init__(self, area_name: str = "") -> None:
+        self.area_name = area_name
+        self.dates = array('l')
+        self.columns = {name: array('q') for name in METRIC_COLUMNS}
+        self.masks = {name: bytearray() for name in METRIC_COLUMNS}
+
+    def __len__(self) -> int:
+        return len(self.dates)
+
+    def append(self, row: dict) -> None:
+        '''
+            Appends a single CSV or JSON row to the series
+        '''
+        if not self.area_name:
+            self.area_name = row.get('areaName') or ""
+        self.dates.append(date.fromisoformat(row['date']).toordinal())
+        for name in METRIC_COLUMNS:
+            value = row.get(name)
+            # the CSV gives blank strings and the JSON gives None for missing data
+            if value is None or value == '':
+                self.columns[name].append(0)
+                self.masks[name].append(0)
+            else:
+                self.columns[name].append(int(value))
+                self.masks[name].append(1)
+
+    def replace(self, index: int, row: dict) -> None:
+        '''
+            Overwrites the metric values of an existing row
+        '''
+        for name in METRIC_COLUMNS:
+            value = row.get(name)
+            if value is None or value == '':
+                self.columns[name][index] = 0
+                self.masks[name][index] = 0
+            else:
+                self.columns[name][index] = int(value)
+                self.masks[name][index] = 1
+
+    def index_of(self, ordinal: int) -> int:
+        '''
+            Returns the row index of a date ordinal, or -1 if it is missing
+        '''
+        # rows are normally one day apart, so try the direct offset first
+        index = self.dates[0] - ordinal if self.dates else -1
+        if 0 <= index < len(self.dates) and self.dates[index] == ordinal:
+            return index
+        try:
+            return self.dates.index(ordinal)
+        except ValueError:
+            return -1
+
+    def merge(self, rows) -> None:
+        '''
+            Merges rows fetched from the API into the series. Rows for dates
+            already in the series overwrite them, newer rows are added to
+            the front.
+        '''
+        newer = []
+        for row in rows:
+            ordinal = date.fromisoformat(row['date']).toordinal()
+            if not self.dates or ordinal > self.dates[0]:
+                newer.append(row)
+                continue
+            index = self.index_of(ordinal)
+            if index != -1:
+                self.replace(index, row)
+
+        if newer:
+            newer.sort(key=lambda row: row['date'], reverse=True)
+            front = CovidSeries.from_rows(newer)
+            self.dates = front.dates + self.dates
+            for name in METRIC_COLUMNS:
+                self.columns[name] = front.columns[name] + self.columns[name]
+                self.masks[name] = front.masks[name] + self.masks[name]
+            if not self.area_name:
+                self.area_name = front.area_name
+
+    def rows(self) -> list:
+        '''
+            Returns the series as a list of row dicts in the JSON layout,
+            with None for missing values
+        '''
+        rows = []
+        for index in range(len(self.dates)):
+            row = {'areaName': self.area_name, 'date': self.date_at(index)}
+            for name in METRIC_COLUMNS:
+                row[name] = self.columns[name][index] if self.masks[name][index] else None
+            rows.append(row)
+        return rows
+
+    def date_at(self, index: int) -> str:
+        '''
+            Returns the date of a row as an ISO formatted string
+        '''
+        return date.fromordinal(self.dates[index]).isoformat()
+
+    def latest(self, name: str) -> int:
+        '''
+            Returns the most recent non-missing value of a metric column,
+            or 0 when the column has no data
+        '''
+        index = self.masks[name].find(1)
+        if index == -1:
+            return 0
+        return self.columns[name][index]
+
+    @classmethod
+    def from_rows(cls, rows) -> 'CovidSeries':
+        '''
+            Builds a series from an iterable of row dicts in one pass
+        '''
+        series = cls()
+        for row in rows:
+            series.append(row)
+        return series
+
+    @classmethod
+    def from_csv(cls, csv_filename: str) -> 'CovidSeries':
+        '''
+            Builds a series from a CSV file saved by the ukcovid19 API
+        '''
+        with open(csv_filename, "r") as csv_file:
+            return cls.from_rows(csv.DictReader(csv_file))
+
+    @classmethod
+    def from_json(cls, json_data: dict) -> 'CovidSeries':
+        '''
+            Builds a series from the dict returned by Cov19API.get_json
+        '''
+        return cls.from_rows(json_data['data'])
+
+
+@timed('parse_csv_data')
+def parse_csv_data(csv_filename: str) -> CovidSeries:
+    '''
+        Takes filename as argument, opens and reads the csv file,
+        returns file content as a CovidSeries
+    '''
+    log.debug("Opening %s for reading", csv_filename)
+    series = CovidSeries.from_csv(csv_filename)
+    log.debug("Successfully read %s rows from %s", len(series), csv_filename)
+
+    return series
 
 # TEST FUNCTION FOR ^ FAIL
 def test_parse_csv_data():
@@ -91,69 +252,69 @@ def test_parse_csv_data():
     data = parse_csv_data("nation_2021-10-28.csv")
     assert len(data) == 639
 
-# DONE I THINK
-def process_covid_data(covid_csv_data: dict) -> tuple[int, int, int]:
+@timed('process_covid')
+def process_covid_batch(areas: dict, windows: tuple = (7,), populations: dict = None,
+        lag: int = None) -> dict:
+    '''
+        Takes a dict of CovidSeries keyed by area and calculates the statistics
+        for every area in one call. For each window in windows the summary has
+        a cases_<n>d total and, when the area is in populations, a rate_<n>d
+        per 100k people. The most recent lag days with case data are skipped
+        because they are still incomplete.
+        Returns a dict of summaries keyed the same way as areas
+    '''
+    if lag is None:
+        lag = get_settings().incomplete_days
+    if populations is None:
+        populations = {}
+
+    summaries = {}
+    for area, series in areas.items():
+        cases = series.columns['newCasesBySpecimenDate']
+        cases_mask = series.masks['newCasesBySpecimenDate']
+
+        # skip empty cells, then the incomplete days that follow them
+        start = cases_mask.find(1)
+        for _ in range(lag):
+            if start == -1:
+                break
+            start = cases_mask.find(1, start + 1)
+
+        summary = {
+            'hospital_cases': series.latest('hospitalCases'),
+            'total_deaths': series.latest('cumDailyNsoDeathsByDeathDate'),
+            'last_complete_date': series.date_at(start) if start != -1 else None,
+        }
+        population = populations.get(area)
+        for window in windows:
+            total = sum(cases[start:start+window]) if start != -1 else 0
+            summary['cases_%sd' % window] = total
+            if population:
+                summary['rate_%sd' % window] = round(total * 100_000 / population, 1)
+        summaries[area] = summary
+
+    log.debug("Processed statistics for %s areas", len(summaries))
+    return summaries
+
+
+def process_covid_data(covid_csv_data: CovidSeries, lag: int = None) -> tuple[int, int, int]:
     '''
-        Takes in a dict, process the data to calculate and return
+        Takes in a CovidSeries, process the data to calculate and return
         last7days_cases, hospitalCases and total_deaths
     '''
 
-    # get case numbers from the last 7 days
-    dataset = covid_csv_data
-
-    last7days_cases = 0
-    last7_index = 0
-
-    # initialize data, checking before calculating
-    logging.debug("Calculating statistics for last 7 days cases")
-    cases = dataset[last7_index]['newCasesBySpecimenDate']
-    date_check = dataset[last7_index]['date']
-
-    # loop through empty cells and skip 2021-10-27 due to incomplete data
-    while (cases == '') or (date_check == '2021-10-27'):
-        last7_index += 1
-        cases = dataset[last7_index]['newCasesBySpecimenDate']
-        date_check = dataset[last7_index]['date']
-
-    # total up the case numbers
-    for i in range(last7_index, last7_index+7):
-        cases = dataset[i]['newCasesBySpecimenDate']
-        last7days_cases = last7days_cases + int(cases)
+    # still accept the old dict of csv rows
+    if isinstance(covid_csv_data, dict):
+        covid_csv_data = CovidSeries.from_rows(covid_csv_data.values())
 
-    logging.debug("Retrieving statistics for most recent hospital cases")
-    # initialize counter
-    hos_index = 0
+    summary = process_covid_batch({None: covid_csv_data}, lag=lag)[None]
+    last7days_cases = summary['cases_7d']
+    hospitalCases = summary['hospital_cases']
+    total_deaths = summary['total_deaths']
 
-    # while cell is empty, continue loop
-    while (dataset[hos_index]['hospitalCases']) == '' and hos_index < (len(dataset)-1):
-        # add to the index counter and reassign data
-        hos_index += 1
-    hospitalCases = dataset[hos_index]['hospitalCases']
-
-    logging.debug("Retrieving statistics for total deaths")
-    # set death_index to top most row
-    death_index = 0
-
-    # loop through empty cells, adding index after every loop
-    while ((dataset[death_index]['cumDailyNsoDeathsByDeathDate']) == ''
-            and death_index < (len(dataset)-1)):
-        # add to the index counter and reassign data
-        death_index += 1
-    total_deaths = covid_csv_data[death_index]['cumDailyNsoDeathsByDeathDate']
-
-
-    if last7days_cases == '':
-        last7days_cases = 0
-    if hospitalCases == '':
-        hospitalCases = 0
-    if total_deaths == '':
-        total_deaths = 0
-
-
-    logging.debug("Last 7 days: %s, Hospital cases: %s, Total deaths: %s."+
+    log.debug("Last 7 days: %s, Hospital cases: %s, Total deaths: %s."+
         "End of process_covid_data func", last7days_cases, hospitalCases, total_deaths)
 
-    # convert strings to int and return
     return (last7days_cases, hospitalCases, total_deaths)
 
 
@@ -168,179 +329,663 @@ def test_process_covid_csv_data():
     assert total_deaths == 141544
 
 
-def covid_API_request(location: str = "Exeter", location_type: str = "ltla") -> str:
+def test_process_covid_batch():
     '''
-        Takes location and location type as variable, get latest Covid
-        statistics using the Covid19API
+        Test function for process_covid_batch, checked against hand-computed
+        values and the loops process_covid_data used before
+    '''
+    latest = date(2021, 10, 28).toordinal()
+    # a blank day, the incomplete 2021-10-27, then complete days
+    cases = ['', '1000'] + [str(100 + i) for i in range(18)]
+    rows = [{'areaName': "Testshire", 'date': date.fromordinal(latest - i).isoformat(),
+        'newCasesBySpecimenDate': cases[i],
+        'hospitalCases': '' if i < 2 else str(50 - i),
+        'cumDailyNsoDeathsByDeathDate': '' if i < 1 else str(900 - i)} for i in range(20)]
+    series = CovidSeries.from_rows(rows)
+
+    summaries = process_covid_batch({'Testshire': series, 'Copy': series}, windows=(7, 14),
+        populations={'Testshire': 250_000}, lag=1)
+    summary = summaries['Testshire']
+    assert summary['last_complete_date'] == '2021-10-26'
+    # 100 to 106 and 100 to 113
+    assert summary['cases_7d'] == 721
+    assert summary['cases_14d'] == 1491
+    assert summary['rate_7d'] == 288.4
+    assert summary['rate_14d'] == 596.4
+    assert summary['hospital_cases'] == 48
+    assert summary['total_deaths'] == 899
+    assert summaries['Copy'] == {key: value for key, value in summary.items()
+        if not key.startswith('rate_')}
+
+    def old_process_covid_data(dataset: list) -> tuple[int, int, int]:
+        index = 0
+        while (dataset[index]['newCasesBySpecimenDate'] == ''
+                or dataset[index]['date'] == '2021-10-27'):
+            index += 1
+        last7days_cases = sum(int(dataset[i]['newCasesBySpecimenDate'])
+            for i in range(index, index + 7))
+        hos_index = 0
+        while dataset[hos_index]['hospitalCases'] == '' and hos_index < len(dataset) - 1:
+            hos_index += 1
+        death_index = 0
+        while (dataset[death_index]['cumDailyNsoDeathsByDeathDate'] == ''
+                and death_index < len(dataset) - 1):
+            death_index += 1
+        return (last7days_cases, int(dataset[hos_index]['hospitalCases']),
+            int(dataset[death_index]['cumDailyNsoDeathsByDeathDate']))
+
+    assert process_covid_data(series, lag=1) == old_process_covid_data(rows)
+    assert process_covid_data(dict(enumerate(rows)), lag=1) == old_process_covid_data(rows)
+
+
+# the structure of how we want to receive the data
+COVID_STRUCTURE = {
+    "areaCode": "areaCode",
+    "areaName": "areaName",
+    "areaType": "areaType",
+    "date": "date",
+    "cumDailyNsoDeathsByDeathDate":"cumDailyNsoDeathsByDeathDate",
+    "hospitalCases": "hospitalCases",
+    "newCasesBySpecimenDate": "newCasesBySpecimenDate"
+}
+
+
+def write_csv_snapshot(save_location: str, rows: list) -> None:
     '''
+        Writes API rows to a CSV file in the layout parse_csv_data reads,
+        meant to be run on a background thread
+    '''
+    try:
+        with open(save_location, 'w', newline='') as csv_output:
+            dict_writer = csv.DictWriter(csv_output, COVID_STRUCTURE.keys(),
+                extrasaction='ignore')
+            dict_writer.writeheader()
+            for row in rows:
+                dict_writer.writerow({key: '' if value is None else value
+                    for key, value in row.items()})
+        log.debug("Saved CSV snapshot %s", save_location)
+    except IOError:
+        log.error("Problem writing CSV snapshot %s", save_location)
+
 
-    save_location = location.lower() + "_covid_data.csv"
+def covid_API_request(location: str = "Exeter", location_type: str = "ltla") -> CovidSeries:
+    '''
+        Takes location and location type as variable, get latest Covid
+        statistics using the Covid19API, returns them as a CovidSeries
+    '''
 
     # setup area filter
-    logging.info("Setting up location filter and structure for covid statistics API request")
+    log.info("Setting up location filter and structure for covid statistics API request")
     location_filter = ['areaType=' + location_type,'areaName=' + location]
 
-    # setup the structure of how we want to receive the data
-    cases_by_location = {
-        "areaCode": "areaCode",
-        "areaName": "areaName",
-        "areaType": "areaType",
-        "date": "date",
-        "cumDailyNsoDeathsByDeathDate":"cumDailyNsoDeathsByDeathDate",
-        "hospitalCases": "hospitalCases",
-        "newCasesBySpecimenDate": "newCasesBySpecimenDate"
-    }
-
     # initialize Cov19API object
-    api = Cov19API(filters=location_filter, structure=cases_by_location)
+    api = Cov19API(filters=location_filter, structure=COVID_STRUCTURE)
 
-    # extract data
+    # extract data with a single request, the payload is parsed in memory
     try:
-        logging.debug("Retrieving data from ukcovid19 API")
-        api.get_json()
-    except Exception as e:
-        logging.error("Error retrieving data from ukcovid19 API, %s", traceback.format_exc())
+        log.debug("Retrieving data from ukcovid19 API")
+        with timed('cov19api'):
+            json_data = api.get_json()
+    except Exception:
+        log.error("Error retrieving data from ukcovid19 API, %s", traceback.format_exc())
+        raise
 
-    api.get_csv(save_as=save_location)
-    logging.debug("Successfully retrieved and saved API data as CSV, %s", save_location)
+    series = CovidSeries.from_json(json_data)
+    log.debug("Successfully retrieved %s rows from ukcovid19 API", len(series))
 
-    return save_location
+    # saving a copy to disk is optional and kept off the request path
+    if get_settings().csv_snapshot:
+        save_location = location.lower() + "_covid_data.csv"
+        task = threading.Thread(target=write_csv_snapshot,
+            args=(save_location, json_data['data']))
+        task.daemon = True
+        task.start()
 
+    return series
 
-def update_covid_data(loc_type: str) -> tuple[int,int,int]:
+
+def covid_store_filename(location: str) -> str:
+    return location.lower() + "_covid_store.bin"
+
+
+def load_covid_store(location: str) -> dict:
     '''
-        Sets different parameters according to the location_type argument
-        Then retrieves COVID 19 statistics from CSV to process the data
-        Returns a tuple of data ready for display on the template
+        Reads the local store saved by save_covid_store, returns None if
+        there is no usable store on disk or it was synced from another endpoint
     '''
-    if loc_type == "local":
-        logging.info("Retrieving latest Covid19 statistics for %s, location type: ltla"
-            , config_location)
-        file_name = covid_API_request(location=config_location, location_type='ltla')
+    json_data = read_snapshot(covid_store_filename(location))
+    if json_data is None:
+        log.debug("No local store found for %s", location)
+        return None
+    if json_data.get('endpoint') != Cov19API.endpoint:
+        log.info("Ignoring local store for %s synced from %s", location,
+            json_data.get('endpoint'))
+        return None
+
+    return {'series': CovidSeries.from_rows(json_data['records']),
+        'endpoint': json_data['endpoint'],
+        'last_update': json_data['lastUpdate'],
+        'latest_complete_date': json_data['latestCompleteDate']}
+
+
+def build_covid_store(key: tuple) -> dict:
+    '''
+        Returns a local store in the layout saved by save_covid_store
+    '''
+    store = covid_stores[key]
+    with covid_store_lock:
+        records = store['series'].rows()
+    return {'endpoint': store['endpoint'],
+        'lastUpdate': store['last_update'],
+        'latestCompleteDate': store['latest_complete_date'],
+        'records': records}
+
+
+def save_covid_store(location: str, location_type: str) -> None:
+    '''
+        Saves the local store of a location in the background, so
+        incremental sync can resume after a restart
+    '''
+    key = (location, location_type)
+    writer = covid_store_writers.get(key)
+    if writer is None:
+        writer = covid_store_writers.setdefault(key, SnapshotWriter(
+            covid_store_filename(location), partial(build_covid_store, key)))
+    writer.mark_dirty()
 
-    elif loc_type == "nation":
-        logging.info("Retrieving latest Covid19 statistics for %s, location type: nation"
-            , config_nation)
-        file_name = covid_API_request(location=config_nation, location_type='nation')
 
+def sync_covid_store(location: str, location_type: str) -> CovidSeries:
+    '''
+        Brings the local store for a location up to date and returns its
+        series. Only the days after the latest complete date are requested,
+        which includes the trailing restated_days that upstream may revise.
+        The full history is only downloaded when there is no store yet or
+        the store is more than max_delta_days behind.
+    '''
+    settings = get_settings()
+    key = (location, location_type)
+    location_filter = ['areaType=' + location_type, 'areaName=' + location]
+
+    store = covid_stores.get(key)
+    if store is None:
+        store = load_covid_store(location)
+    # only a store that changed is saved
+    changed = False
+
+    if store is not None and len(store['series']):
+        # a HEAD request tells us whether upstream has published anything new
+        with timed('cov19api'):
+            last_update = Cov19API(filters=location_filter, structure=COVID_STRUCTURE).last_update
+        since = date.fromisoformat(store['latest_complete_date'])
+        latest = date.fromordinal(store['series'].dates[0])
+        delta_days = (date.today() - latest).days
+
+        if last_update == store['last_update']:
+            log.debug("No new data for %s since %s", location, last_update)
+        elif delta_days > settings.max_delta_days:
+            log.info("Local store for %s is %s days behind, downloading full history",
+                location, delta_days)
+            store = None
+        else:
+            # the restated days are requested again, then newer days until
+            # upstream has nothing for one, instead of every day up to today
+            day = since + timedelta(days=1)
+            while day <= date.today():
+                api = Cov19API(filters=location_filter + ['date=' + day.isoformat()],
+                    structure=COVID_STRUCTURE)
+                with timed('cov19api'):
+                    json_data = api.get_json()
+                if not json_data['data'] and day > latest:
+                    break
+                with covid_store_lock:
+                    store['series'].merge(json_data['data'])
+                day += timedelta(days=1)
+            log.debug("Requested data from %s to %s for %s", since + timedelta(days=1),
+                day, location)
+            store['last_update'] = last_update
+            changed = True
+    else:
+        store = None
+
+    if store is None:
+        log.debug("Retrieving full history from ukcovid19 API for %s", location)
+        with timed('cov19api'):
+            json_data = Cov19API(filters=location_filter, structure=COVID_STRUCTURE).get_json()
+        store = {'series': CovidSeries.from_json(json_data), 'endpoint': Cov19API.endpoint,
+            'last_update': json_data['lastUpdate']}
+        changed = True
+
+    # the most recent days may still be restated, everything before them is complete
+    series = store['series']
+    if len(series):
+        store['latest_complete_date'] = date.fromordinal(
+            series.dates[0] - settings.restated_days).isoformat()
     else:
-        logging.critical("Invalid location type (%s), should be either local or nation", loc_type)
-        exit()
+        store['latest_complete_date'] = date.today().isoformat()
 
-    last7days_cases, hospitalCases, total_deaths = process_covid_data(parse_csv_data(file_name))
-    logging.debug("Successfully retrieved COVID 19 statistics")
-    return (last7days_cases, hospitalCases, total_deaths)
+    covid_stores[key] = store
+    if changed:
+        save_covid_store(location, location_type)
+    log.debug("Local store for %s is complete up to %s", location,
+        store['latest_complete_date'])
+
+    return series
 
 
-def schedule_covid_updates(update_interval, update_name: str, *repeat) -> None:
+def fetch_covid_series(location: str, location_type: str) -> CovidSeries:
     '''
-        This function takes in arguments and schedules a COVID-19
-        statistics update according to the time provided.
+        Fetches the latest COVID 19 statistics for a location as a CovidSeries,
+        waiting for a free slot in the shared API quota first
     '''
+    with api_quota:
+        if get_settings().incremental_sync:
+            return sync_covid_store(location, location_type)
+        return covid_API_request(location=location, location_type=location_type)
 
-    global config_location
-    global config_nation
-    global covid_sched_list
 
+def fetch_covid_stats(location: str, location_type: str) -> tuple[int, int, int]:
+    '''
+        Fetches and processes the latest COVID 19 statistics for a location,
+        bypassing the statistics cache
+    '''
+    return process_covid_data(fetch_covid_series(location, location_type))
 
-    logging.debug("Converting user time input (%s) to seconds since epoch", update_interval)
-    # process time from arguments and split it into 2 variables
-    update_hours, update_minutes = map(int, update_interval.split(':'))
-    # get update time in seconds
-    update_time_in_seconds = (update_hours * 60 * 60) + (update_minutes * 60)
 
-    # set up current date and time as variables for comparison
-    current_date_time = datetime.now()
-    temp_time = time.time()
+def refresh_covid_stats(location: str, location_type: str) -> tuple[int, int, int]:
+    '''
+        Refreshes the cached statistics for a location. Concurrent callers
+        for the same location share a single upstream fetch. A caller that
+        waits longer than REFRESH_WAIT_TIMEOUT for it gets the stale
+        statistics, or TimeoutError if there are none.
+    '''
+    key = (location, location_type)
+
+    with stats_cache_lock:
+        inflight = stats_inflight.get(key)
+        leader = inflight is None
+        if leader:
+            # no refresh running, this caller does the fetch
+            inflight = claim_refresh(key)
+
+    if not leader:
+        log.debug("Waiting on in-flight refresh for %s", location)
+        if not inflight['event'].wait(REFRESH_WAIT_TIMEOUT):
+            with stats_cache_lock:
+                entry = stats_cache.get(key)
+            if entry is None:
+                raise TimeoutError("Timed out waiting on refresh for " + location)
+            log.warning("Timed out waiting on refresh for %s, using stale statistics", location)
+            return entry['stats']
+        if inflight['error'] is not None:
+            raise inflight['error']
+        return stats_cache[key]['stats']
 
-    # Get HH:MM time format from the current time
-    current_time = datetime.fromtimestamp(temp_time).strftime('%H:%M')
+    try:
+        stats = fetch_covid_stats(location, location_type)
+    except Exception as error:
+        inflight['error'] = error
+        raise
+    else:
+        with stats_cache_lock:
+            store_stats(key, stats, time.monotonic())
+        stats_snapshot_writer.mark_dirty()
+        return stats
+    finally:
+        release_refresh(key, inflight)
 
-    # Split hours and minutes into 2 variables
-    curr_hours, curr_minutes = map(int, current_time.split(':'))
 
-    # Get current time in seconds
-    curr_time_in_seconds = (curr_hours * 60 * 60) + (curr_minutes * 60)
+def store_stats(key: tuple, stats: tuple, fetched_at: float) -> None:
+    '''
+        Puts statistics into the cache along with their JSON serialisation
+        and ETag for the API, callers hold stats_cache_lock.
+        stats_version is bumped when the statistics change
+    '''
+    global stats_version
+    entry = stats_cache.get(key)
+    if entry is not None and entry['stats'] == stats:
+        stats_cache[key] = dict(entry, fetched_at=fetched_at)
+        return
+
+    location, location_type = key
+    last7days_cases, hospital_cases, total_deaths = stats
+    body = json.dumps({'area': location, 'areaType': location_type,
+        'last7DaysCases': last7days_cases, 'hospitalCases': hospital_cases,
+        'totalDeaths': total_deaths}, separators=(",", ":")).encode()
+    stats_cache[key] = {'stats': stats, 'fetched_at': fetched_at, 'json': body,
+        'etag': hashlib.sha1(body).hexdigest()}
+    stats_version += 1
+
+
+def claim_refresh(key: tuple) -> dict:
+    '''
+        Marks a cache key as being refreshed, callers hold stats_cache_lock
+    '''
+    inflight = {'event': threading.Event(), 'error': None}
+    stats_inflight[key] = inflight
+    return inflight
 
-    logging.debug("Initializing Covid sched function")
 
-    # Check if time has past then sets the date accordingly
-    if curr_time_in_seconds < update_time_in_seconds:
-        day = current_date_time.day
-    else:
-        day = current_date_time.day + 1
+def release_refresh(key: tuple, inflight: dict) -> None:
+    '''
+        Ends a refresh started with claim_refresh and wakes its waiters
+    '''
+    with stats_cache_lock:
+        del stats_inflight[key]
+    inflight['event'].set()
 
-    # Set update time into datetime type for processing
-    update_date_time = datetime(current_date_time.year, current_date_time.month,
-        day, update_hours, update_minutes)
 
-    date_time_diff = update_date_time-current_date_time
-    time_diff_seconds = date_time_diff.total_seconds()
+def refresh_areas(areas: list, location_type: str = 'ltla') -> dict:
+    '''
+        Refreshes the cached statistics for many areas as one batch. The
+        series are fetched by a small pool sharing the API quota and
+        processed together with process_covid_batch. Areas that are
+        already being refreshed are skipped.
+        Returns the summaries keyed by area
+    '''
+    claimed = {}
+    with stats_cache_lock:
+        for area in areas:
+            key = (area, location_type)
+            if key not in stats_inflight:
+                claimed[area] = claim_refresh(key)
+
+    series = {}
+    summaries = {}
+    try:
+        with ThreadPoolExecutor(max_workers=get_settings().area_fetch_workers) as pool:
+            futures = {area: pool.submit(fetch_covid_series, area, location_type)
+                for area in claimed}
+            for area, future in futures.items():
+                try:
+                    series[area] = future.result()
+                except Exception as error:
+                    claimed[area]['error'] = error
+                    log.error("Problem fetching statistics for %s, %s", area,
+                        traceback.format_exc())
+
+        summaries = process_covid_batch(series)
+        fetched_at = time.monotonic()
+        with stats_cache_lock:
+            for area, summary in summaries.items():
+                store_stats((area, location_type), (summary['cases_7d'],
+                    summary['hospital_cases'], summary['total_deaths']), fetched_at)
+        stats_snapshot_writer.mark_dirty()
+    except Exception as error:
+        for inflight in claimed.values():
+            inflight['error'] = inflight['error'] or error
+        raise
+    finally:
+        for area, inflight in claimed.items():
+            release_refresh((area, location_type), inflight)
+
+    log.info("Refreshed statistics for %s of %s areas", len(summaries), len(areas))
+    return summaries
+
+
+def start_area_refresh() -> None:
+    '''
+        Keeps the statistics for every configured area warm by refreshing
+        them in the background as one batch, once per cache TTL
+    '''
+    settings = get_settings()
+    if settings.areas:
+        scheduler.schedule(0, partial(refresh_areas, list(settings.areas)), 'areas',
+            interval=settings.stats_cache_ttl, group=INTERNAL_GROUP)
 
-    task1 = threading.Timer(time_diff_seconds, update_covid_data("local"))
-    task2 = threading.Timer(time_diff_seconds, update_covid_data("nation"))
-    task1.daemon = True
-    task2.daemon = True
-    task1.start()
-    task2.start()
 
-    # store thread details in a list of dicts
-    temp1 = {'update_name':update_name, 'task':task1}
-    temp2 = {'update_name':update_name, 'task':task2}
-    covid_sched_list.append(temp1)
-    covid_sched_list.append(temp2)
+def build_stats_snapshot() -> dict:
+    '''
+        Returns the statistics cache in the layout saved to stats_snapshot,
+        with the time each entry was fetched in seconds since epoch
+    '''
+    offset = time.time() - time.monotonic()
+    with stats_cache_lock:
+        entries = [[location, location_type, list(entry['stats']), entry['fetched_at'] + offset]
+            for (location, location_type), entry in stats_cache.items()]
+    return {'stats': entries}
 
-    logging.debug("Sucessfully added %s and %s to threading queue", task1, task2)
 
-    # recursive loop
-    if repeat is True:
-        time_diff_seconds = time_diff_seconds + 86400
-        new_update_interval = datetime.fromtimestamp(time_diff_seconds).strftime('%c')
-        schedule_covid_updates(new_update_interval, update_name, True)
+def load_stats_snapshot() -> None:
+    '''
+        Fills the statistics cache from stats_snapshot, keeping each entry's
+        age so stale entries are served while they are revalidated
+    '''
+    stats_snapshot = get_settings().stats_snapshot
+    if not stats_snapshot:
+        return
+    json_data = read_snapshot(stats_snapshot)
+    if json_data is None:
+        return
+
+    offset = time.time() - time.monotonic()
+    with stats_cache_lock:
+        for location, location_type, stats, fetched_at in json_data['stats']:
+            if (location, location_type) not in stats_cache:
+                store_stats((location, location_type), tuple(stats), fetched_at - offset)
+    log.info("Loaded %s cached statistics from %s", len(json_data['stats']), stats_snapshot)
+
+
+stats_snapshot_writer = SnapshotWriter(get_settings().stats_snapshot, build_stats_snapshot)
+load_stats_snapshot()
+
+
+def settings_changed(old: Settings, new: Settings, changed: set) -> None:
+    '''
+        Reload listener, resets only what the changed settings affect
+    '''
+    global api_quota, stats_version
+    if 'cov19_endpoint' in changed:
+        apply_endpoint(new)
+        # the local stores were synced from the old endpoint, pending saves
+        # are dropped and stores on disk are ignored by load_covid_store
+        for writer in covid_store_writers.values():
+            writer.cancel()
+        covid_store_writers.clear()
+        covid_stores.clear()
+    if 'max_api_requests' in changed:
+        api_quota = threading.BoundedSemaphore(new.max_api_requests)
+    if changed & {'cov19_endpoint', 'incomplete_days'}:
+        with stats_cache_lock:
+            stats_cache.clear()
+            stats_version += 1
+        stats_snapshot_writer.mark_dirty()
+    if 'stats_snapshot' in changed:
+        stats_snapshot_writer.filename = new.stats_snapshot
+    if changed & {'areas', 'stats_cache_ttl'}:
+        scheduler.cancel_name('areas', INTERNAL_GROUP)
+        scheduler.forget('areas', INTERNAL_GROUP)
+        start_area_refresh()
+
+add_reload_listener(settings_changed)
+
+
+def background_refresh(location: str, location_type: str) -> None:
+    '''
+        Target for the stale-while-revalidate thread, errors are logged
+        and the stale statistics are kept
+    '''
+    try:
+        refresh_covid_stats(location, location_type)
+    except Exception:
+        log.error("Background refresh failed for %s, %s", location, traceback.format_exc())
+
+
+def get_covid_stats(location: str, location_type: str) -> tuple[int, int, int]:
+    '''
+        Returns statistics for a location from the statistics cache.
+        Fresh entries are returned as they are, stale entries are returned
+        while a background thread revalidates them, and missing entries
+        are fetched before returning.
+    '''
+    key = (location, location_type)
+
+    with stats_cache_lock:
+        entry = stats_cache.get(key)
+        refreshing = key in stats_inflight
+
+    if entry is None:
+        log.debug("Statistics cache miss for %s", location)
+        cache_result('stats', 'miss')
+        return refresh_covid_stats(location, location_type)
+
+    if time.monotonic() - entry['fetched_at'] <= get_settings().stats_cache_ttl:
+        cache_result('stats', 'hit')
+        return entry['stats']
+
+    cache_result('stats', 'stale')
+    if not refreshing:
+        log.debug("Statistics for %s are stale, revalidating in background", location)
+        task = threading.Thread(target=background_refresh, args=(location, location_type))
+        task.daemon = True
+        task.start()
+
+    return entry['stats']
+
+
+def current_stats_version() -> int:
+    '''
+        Returns stats_version, which changes whenever cached statistics change
+    '''
+    return stats_version
+
+
+def stats_json(location: str, location_type: str) -> tuple[bytes, str]:
+    '''
+        Returns the cached statistics for a location serialised as JSON
+        for the API, with a strong ETag
+    '''
+    get_covid_stats(location, location_type)
+    with stats_cache_lock:
+        entry = stats_cache[(location, location_type)]
+    return entry['json'], entry['etag']
+
+
+def stats_json_changes(seen_etags: dict) -> list:
+    '''
+        Returns the JSON of every cached location whose statistics changed
+        since seen_etags was last passed in, and updates seen_etags
+    '''
+    with stats_cache_lock:
+        entries = list(stats_cache.items())
+
+    changes = []
+    for key, entry in entries:
+        if seen_etags.get(key) != entry['etag']:
+            seen_etags[key] = entry['etag']
+            changes.append(entry['json'])
+    return changes
+
+
+def covid_location(loc_type: str) -> tuple[str, str]:
+    '''
+        Returns the configured location and its API location type for
+        a loc_type of local or nation
+    '''
+    settings = get_settings()
+    if loc_type == "local":
+        return (settings.location, 'ltla')
+    if loc_type == "nation":
+        return (settings.nation, 'nation')
+
+    log.critical("Invalid location type (%s), should be either local or nation", loc_type)
+    exit()
+
+
+def stats_are_fresh(location: str, location_type: str, margin: float = 0) -> bool:
+    '''
+        Checks whether the cached statistics for a location
+        are within the cache TTL, and will be for margin more seconds
+    '''
+    with stats_cache_lock:
+        entry = stats_cache.get((location, location_type))
+    return (entry is not None
+        and time.monotonic() - entry['fetched_at'] + margin <= get_settings().stats_cache_ttl)
+
+
+def covid_data_is_fresh(loc_type: str, margin: float = 0) -> bool:
+    '''
+        Checks whether the cached statistics for local or nation
+        are within the cache TTL, and will be for margin more seconds
+    '''
+    location, location_type = covid_location(loc_type)
+    return stats_are_fresh(location, location_type, margin)
 
 
-def check_covid_updates(displayed_updates_list: list) -> list:
+def update_covid_data(loc_type: str) -> tuple[int,int,int]:
+    '''
+        Sets different parameters according to the location_type argument
+        Then retrieves COVID 19 statistics from the statistics cache
+        Returns a tuple of data ready for display on the template
+    '''
+    location, location_type = covid_location(loc_type)
+    # runs for every page served, so only logs at debug level
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Retrieving latest Covid19 statistics for %s, location type: %s"
+            , location, location_type)
+    stats = get_covid_stats(location, location_type)
+
+    last7days_cases, hospitalCases, total_deaths = stats
+    return (last7days_cases, hospitalCases, total_deaths)
+
+
+def refresh_covid_data(loc_type: str) -> tuple[int,int,int]:
+    '''
+        To be used with schedule_covid_updates function,
+        Fetches the latest statistics for local or nation and publishes
+        them to the statistics cache, so pages are served warm
+    '''
+    location, location_type = covid_location(loc_type)
+    log.info("Refreshing Covid19 statistics for %s, location type: %s"
+        , location, location_type)
+    return refresh_covid_stats(location, location_type)
+
+
+def schedule_covid_updates(update_interval: str, update_name: str, repeat: bool = False) -> None:
+    '''
+        This function takes in arguments and schedules a COVID-19
+        statistics update according to the time provided, as HH:MM.
+        If repeat is set, the update runs every day at that time.
+    '''
+
+    log.debug("Scheduling Covid update %s at %s, repeat: %s",
+        update_name, update_interval, repeat)
+    spec = DailyAt.parse(update_interval)
+
+    # jobs are registered with the scheduler under the update name
+    task1 = scheduler.schedule_daily(spec, partial(refresh_covid_data, "local"),
+        update_name, group='covid', repeat=repeat)
+    task2 = scheduler.schedule_daily(spec, partial(refresh_covid_data, "nation"),
+        update_name, group='covid', repeat=repeat)
+
+    log.debug("Sucessfully added %s and %s to scheduler queue", task1, task2)
+
+
+def check_covid_updates(displayed_updates_list: list) -> None:
     '''
         This function accepts updates_list as an argument and
-        performs comparisons with the threading queue to check
-        for threads that have already been executed.
-
-        Remove executed threads from updates_list
-    '''
-
-    log.debug("Checking for expired updates")
-
-
-    global covid_sched_list
-    del_index_list = []
-
-    # check if list is not empty then loop through it
-    if displayed_updates_list != []:
-        for index, each in enumerate(displayed_updates_list):
-            match = 0
-            name_search = each['title']
-            for line in covid_sched_list:
-                # cross reference with thread dict from schedule_news_updates function
-                log.debug("Search key: %s, Current: %s", name_search, line['update_name'])
-                if name_search == line['update_name']:
-                    # look through thread queue to find matches
-                    for thread in threading.enumerate():
-                        log.debug(thread,line['task'])
-                        # thread hasn't been executed yet, removal not required
-                        if thread == line['task']:
-                            match += 1
-                    # no match = thread executed, add index to a list for removal
-                    if match == 0:
-                        del_index_list.append(index)
-
-        # remove outdated lists
-        for every in del_index_list:
-            del displayed_updates_list[every]
-    else:
-        log.debug("Updates list is empty")
+        looks up the state of each update's jobs in the scheduler
+        registry to check for jobs that have already been executed.
+
+        Remove executed jobs from updates_list
+    '''
+
+    expired = set()
+    for each in displayed_updates_list:
+        if scheduler.state(each['title'], 'covid') in ('done', 'cancelled'):
+            expired.add(each['title'])
+
+    # remove outdated updates in place
+    if expired:
+        displayed_updates_list[:] = [each for each in displayed_updates_list
+            if each['title'] not in expired]
+        log.debug("Removed finished Covid updates: %s", expired)
 
-    log.debug("Returned updates list: %s", displayed_updates_list)
 
 def remove_task(update_item: str) -> None:
-    log.debug("Removing: %s from threads", update_item)
-    
\ No newline at end of file
+    '''
+        Cancels every scheduled job for an update
+    '''
+    log.debug("Removing: %s from scheduler", update_item)
+    cancelled = scheduler.cancel_name(update_item)
+    scheduler.forget(update_item)
+    log.info("Cancelled %s scheduled jobs for %s", cancelled, update_item)
@@ -0,0 +1,82 @@
+'''
+This module contains the broadcaster that pushes data changes to
+connected pages as server-sent events
+'''
+import logging
+import queue
+import threading
+
+
+log = logging.getLogger(__name__)
+
+
+def format_event(event: str, data: bytes) -> bytes:
+    '''
+        Formats one server-sent event, data must not contain newlines
+    '''
+    return b"event: " + event.encode() + b"\ndata: " + data + b"\n\n"
+
+
+class EventBroadcaster:
+    '''
+        Fans events out to every connected client. Each event is formatted
+        once and the same bytes are queued for every client, so publishing
+        costs the same however many pages are open. Clients that stop
+        reading and fill their queue are dropped
+    '''
+
+    def __init__(self, max_queued: int = 100) -> None:
+        self.max_queued = max_queued
+        self.clients = set()
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.clients)
+
+    def subscribe(self) -> queue.Queue:
+        client = queue.Queue(maxsize=self.max_queued)
+        with self.lock:
+            self.clients.add(client)
+        log.debug("Event client connected, %s connected", len(self.clients))
+        return client
+
+    def unsubscribe(self, client: queue.Queue) -> None:
+        with self.lock:
+            self.clients.discard(client)
+        log.debug("Event client disconnected, %s connected", len(self.clients))
+
+    def publish(self, event: str, data: bytes) -> None:
+        message = format_event(event, data)
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            try:
+                client.put_nowait(message)
+            except queue.Full:
+                log.warning("Dropping event client that is not reading")
+                self.unsubscribe(client)
+                # wake the client's stream so it can finish
+                with client.mutex:
+                    client.queue.clear()
+                client.put_nowait(None)
+        log.debug("Published %s event to %s clients", event, len(clients))
+
+    def stream(self, keepalive: float = 15, retry: int = 5000):
+        '''
+            Generator of the bytes sent to one client, sends a comment
+            every keepalive seconds so idle connections aren't closed
+        '''
+        client = self.subscribe()
+        try:
+            yield b"retry: " + str(retry).encode() + b"\n\n"
+            while True:
+                try:
+                    message = client.get(timeout=keepalive)
+                except queue.Empty:
+                    yield b": keepalive\n\n"
+                    continue
+                if message is None:
+                    return
+                yield message
+        finally:
+            self.unsubscribe(client)
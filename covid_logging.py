@@ -0,0 +1,61 @@
+'''
+This module sets up logging for the app. Records are put on a queue by the
+thread that logs them, and formatted and written by a listener thread, so
+slow output never holds up a request
+'''
+import atexit
+import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+from covid_settings import add_reload_listener, get_settings
+
+
+log = logging.getLogger(__name__)
+
+FORMAT = '%(levelname)s: %(asctime)s %(message)s'
+
+log_queue = queue.Queue()
+global log_listener
+log_listener = None
+
+def apply_levels(old_levels: dict = None) -> None:
+    '''
+        Sets the root level from logLevel and single modules' levels from
+        logLevels, e.g. {"covid_scheduler": "DEBUG"}
+    '''
+    settings = get_settings()
+    logging.getLogger().setLevel(settings.log_level)
+    # modules dropped from logLevels go back to the root level
+    for name in (old_levels or {}).keys() - settings.log_levels.keys():
+        logging.getLogger(name).setLevel(logging.NOTSET)
+    for name, level in settings.log_levels.items():
+        logging.getLogger(name).setLevel(level)
+
+def settings_changed(old, new, changed: set) -> None:
+    if changed & {'log_level', 'log_levels'}:
+        apply_levels(old.log_levels)
+
+def setup_logging() -> None:
+    '''
+        Sends log records through log_queue to a listener writing to stdout
+        and sets the configured levels. Safe to call from every module,
+        only the first call sets anything up
+    '''
+    global log_listener
+    if log_listener is not None:
+        return
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(FORMAT))
+    log_listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    log_listener.start()
+    # write out queued records before exiting
+    atexit.register(log_listener.stop)
+
+    logging.getLogger().addHandler(QueueHandler(log_queue))
+    apply_levels()
+    add_reload_listener(settings_changed)
+    log.debug("Logging at %s, module levels: %s", get_settings().log_level,
+        dict(get_settings().log_levels))
@@ -0,0 +1,144 @@
+'''
+This module contains the app's instrumentation: timers around each stage
+of serving a page, counters and gauges, exposed in the Prometheus text
+format and as Server-Timing headers
+'''
+import threading
+import time
+from contextlib import contextmanager
+
+
+PREFIX = 'covid_'
+
+# stage -> [count, total seconds, errors]
+stages = {}
+# (name, labels) -> value, labels is a tuple of (label, value) pairs
+counters = {}
+# name -> (help, function returning the current value)
+gauges = {}
+metrics_lock = threading.Lock()
+
+# timings of the request being served by this thread, see start_request
+request_timings = threading.local()
+
+
+def observe(stage: str, seconds: float, error: bool = False) -> None:
+    '''
+        Records one run of a stage, and adds it to the current
+        request's timings if this thread is serving a request
+    '''
+    with metrics_lock:
+        totals = stages.get(stage)
+        if totals is None:
+            totals = stages[stage] = [0, 0.0, 0]
+        totals[0] += 1
+        totals[1] += seconds
+        if error:
+            totals[2] += 1
+
+    add_timing(stage, seconds)
+
+
+def add_timing(name: str, seconds: float) -> None:
+    '''
+        Adds to the current request's timings only, for time spent
+        waiting on work that was timed on another thread
+    '''
+    timings = getattr(request_timings, 'timings', None)
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+@contextmanager
+def timed(stage: str):
+    '''
+        Times a block or, used as a decorator, every call of a function.
+        Exceptions are counted as errors of the stage
+    '''
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        observe(stage, time.perf_counter() - started, error=True)
+        raise
+    observe(stage, time.perf_counter() - started)
+
+
+def inc(name: str, amount: float = 1, **labels) -> None:
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        counters[key] = counters.get(key, 0) + amount
+
+
+def cache_result(cache: str, result: str) -> None:
+    '''
+        Counts a cache lookup, result is hit, stale or miss
+    '''
+    inc('cache_requests_total', cache=cache, result=result)
+
+
+def add_gauge(name: str, help: str, value) -> None:
+    '''
+        Registers a gauge, value is called for its value when metrics are read
+    '''
+    gauges[name] = (help, value)
+
+
+def start_request() -> None:
+    request_timings.timings = {}
+    request_timings.started = time.perf_counter()
+
+
+def end_request() -> str:
+    '''
+        Stops collecting timings for this thread's request and returns
+        them as a Server-Timing header value, durations in milliseconds
+    '''
+    timings = getattr(request_timings, 'timings', None)
+    if timings is None:
+        return None
+    request_timings.timings = None
+
+    parts = ["%s;dur=%.1f" % (stage, seconds * 1000) for stage, seconds in timings.items()]
+    parts.append("total;dur=%.1f" % ((time.perf_counter() - request_timings.started) * 1000))
+    return ", ".join(parts)
+
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (label, str(value).replace('"', '\\"'))
+        for label, value in labels) + "}"
+
+
+def render_metrics() -> bytes:
+    '''
+        Returns every metric in the Prometheus text exposition format
+    '''
+    with metrics_lock:
+        stage_totals = sorted((stage, list(totals)) for stage, totals in stages.items())
+        counter_values = sorted(counters.items())
+
+    lines = ["# HELP %sstage_seconds Time spent in each stage" % PREFIX,
+        "# TYPE %sstage_seconds summary" % PREFIX]
+    for stage, (count, seconds, errors) in stage_totals:
+        lines.append('%sstage_seconds_count{stage="%s"} %s' % (PREFIX, stage, count))
+        lines.append('%sstage_seconds_sum{stage="%s"} %.6f' % (PREFIX, stage, seconds))
+    lines.append("# HELP %sstage_errors_total Runs of each stage that raised" % PREFIX)
+    lines.append("# TYPE %sstage_errors_total counter" % PREFIX)
+    for stage, (count, seconds, errors) in stage_totals:
+        lines.append('%sstage_errors_total{stage="%s"} %s' % (PREFIX, stage, errors))
+
+    typed = set()
+    for (name, labels), value in counter_values:
+        if name not in typed:
+            lines.append("# TYPE %s%s counter" % (PREFIX, name))
+            typed.add(name)
+        lines.append("%s%s%s %s" % (PREFIX, name, format_labels(labels), value))
+
+    for name, (help, value) in sorted(gauges.items()):
+        lines.append("# HELP %s%s %s" % (PREFIX, name, help))
+        lines.append("# TYPE %s%s gauge" % (PREFIX, name))
+        lines.append("%s%s %s" % (PREFIX, name, value()))
+
+    return ("\n".join(lines) + "\n").encode()
@@ -3,67 +3,396 @@ This module contains functions that uses NewsAPI to retrieve news articles
 and processes the data and save it in a CSV
 '''
 import json
+import hashlib
 import time
 import requests, csv
-import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime
+from urllib.parse import quote_plus
 import threading
 import logging
-import sys
+import traceback
+from collections import OrderedDict
+from covid_logging import setup_logging
+from covid_metrics import timed, cache_result
+from covid_scheduler import DailyAt, scheduler
+from covid_settings import Settings, add_reload_listener, config_loaded, get_settings
+from covid_snapshot import SnapshotWriter, read_snapshot
 
 
 log = logging.getLogger(__name__)
-FORMAT= '%(levelname)s: %(asctime)s %(message)s'
-logging.basicConfig(format=FORMAT, stream=sys.stdout, level=logging.DEBUG)
+setup_logging()
 
 
 global covid_search
 gcovid_search = "Covid COVID-19 coronavirus"
 
-# config file name
-config_file = 'covid_config.cfg'
-global config_error
-config_error = False
-global apiKey
-apiKey = "set_in_config"
 global exclude_list
 exclude_list = []
 global threads
 threads = []
-global news_dict
-news_dict = {}
-global news_csv
-news_csv = "set_in_config"
-global news_sched_list
-news_sched_list = []
-
-everything_news_url = 'https://newsapi.org/v2/everything'
-
-def read_config() -> None:
-    global apiKey
-    global news_csv
+
+# shared session so NewsAPI requests reuse pooled keep-alive connections
+news_session = requests.Session()
+news_retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=('GET',))
+news_session.mount('https://', HTTPAdapter(pool_maxsize=4, max_retries=news_retry))
+news_session.mount('http://', HTTPAdapter(pool_maxsize=4, max_retries=news_retry))
+# connect and read timeouts for each try, so a hung connection can't hold a worker
+NEWSAPI_TIMEOUT = (3.05, 10)
+# removed titles excluded in the query, older ones are only filtered locally
+MAX_QUERY_EXCLUSIONS = 10
+
+# NewsAPI responses keyed by the normalized query
+news_cache = {}
+news_cache_lock = threading.Lock()
+# when news_store was last filled from NewsAPI, as time.monotonic()
+global news_refreshed_at
+news_refreshed_at = None
+# held while get_news refreshes the news in the background
+news_refresh_lock = threading.Lock()
+# (news_store.version, JSON body, ETag) last served by news_json
+news_json_cache = None
+# articles currently saved in the news CSV
+global news_csv_articles
+news_csv_articles = None
+news_csv_lock = threading.Lock()
+
+class Article:
+    '''
+        A single news article from NewsAPI. Fields use the NewsAPI names and
+        can be read with subscripts, so templates can use article['title']
+    '''
+
+    __slots__ = ('source', 'author', 'title', 'description', 'url', 'urlToImage',
+        'publishedAt', 'content')
+
+    def __init__(self, **fields) -> None:
+        for name in self.__slots__:
+            value = fields.get(name)
+            setattr(self, name, "" if value is None else value)
+
+    def __getitem__(self, name: str) -> str:
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name) from None
+
+    def __repr__(self) -> str:
+        return "Article(%r)" % self.title
+
+    @classmethod
+    def from_json(cls, json_article: dict) -> 'Article':
+        '''
+            Builds an article from one entry of the NewsAPI articles list
+        '''
+        fields = dict(json_article)
+        # NewsAPI nests the source as {"id": ..., "name": ...}
+        source = fields.get('source')
+        if isinstance(source, dict):
+            fields['source'] = source.get('name')
+        return cls(**fields)
+
+    def to_row(self) -> list:
+        return [getattr(self, name) for name in self.__slots__]
+
+
+class ArticleStore:
+    '''
+        A bounded window of news articles, deduplicated by URL with an index
+        from each title to the URLs stored under it. New articles push the oldest ones out once the window holds
+        news_window_size articles, and articles older than news_max_age_hours
+        are dropped. Removed titles are tombstoned so later updates skip them,
+        and are appended to a removal log in batches instead of rewriting a file
+    '''
+
+    def __init__(self) -> None:
+        # oldest first, so the oldest article is evicted first
+        self.articles = OrderedDict()
+        self.titles = {}
+        self.published = {}
+        self.removed = set()
+        self.pending = []
+        self.flush_timer = None
+        self.lock = threading.Lock()
+        # bumped whenever the articles in the window change
+        self.version = 0
+
+    def __len__(self) -> int:
+        return len(self.articles)
+
+    def add(self, articles: list) -> None:
+        '''
+            Adds the results of a news update to the window, leaving out
+            removed titles and refreshing articles that are already stored
+        '''
+        now = time.time()
+        oldest_allowed = now - get_settings().news_max_age_hours * 60 * 60
+        with self.lock:
+            self.expire(now)
+            # NewsAPI lists the newest articles first
+            for article in reversed(articles):
+                published = published_timestamp(article, now)
+                if article.title in self.removed or published < oldest_allowed:
+                    continue
+                key = article.url or article.title
+                if key in self.articles:
+                    if self.articles[key].to_row() != article.to_row():
+                        self.version += 1
+                    self.unindex(self.articles[key].title, key)
+                    self.articles.move_to_end(key)
+                else:
+                    self.version += 1
+                self.articles[key] = article
+                self.published[key] = published
+                # syndicated copies share a title under different URLs
+                self.titles.setdefault(article.title, set()).add(key)
+
+            while len(self.articles) > get_settings().news_window_size:
+                self.evict(next(iter(self.articles)))
+
+    def evict(self, key: str) -> None:
+        self.version += 1
+        article = self.articles.pop(key)
+        del self.published[key]
+        self.unindex(article.title, key)
+
+    def unindex(self, title: str, key: str) -> None:
+        keys = self.titles.get(title)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.titles[title]
+
+    def expire(self, now: float) -> None:
+        '''
+            Drops articles older than news_max_age_hours, callers hold the lock
+        '''
+        oldest_allowed = now - get_settings().news_max_age_hours * 60 * 60
+        expired = [key for key, published in self.published.items()
+            if published < oldest_allowed]
+        for key in expired:
+            self.evict(key)
+
+    def remove(self, title: str) -> bool:
+        '''
+            Removes every article with a title in constant time,
+            returns False if the title was already removed
+        '''
+        with self.lock:
+            if title in self.removed:
+                return False
+            self.removed.add(title)
+            for key in list(self.titles.get(title, ())):
+                self.evict(key)
+            self.pending.append(title)
+
+            # debounce, a burst of removals is flushed to disk in one write
+            if self.flush_timer is None:
+                self.flush_timer = threading.Timer(get_settings().removal_flush_delay, self.flush)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+        return True
+
+    def window(self) -> list:
+        '''
+            Returns the stored articles as a list for display, newest first
+        '''
+        with self.lock:
+            self.expire(time.time())
+            keys = sorted(self.articles, key=self.published.__getitem__, reverse=True)
+            return [self.articles[key] for key in keys]
+
+    def flush(self) -> None:
+        '''
+            Appends pending removals to the removal log
+        '''
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+            self.flush_timer = None
+        if not pending:
+            return
+
+        removal_log = get_settings().removal_log
+        try:
+            with open(removal_log, 'a') as log_file:
+                log_file.writelines(json.dumps(title) + "\n" for title in pending)
+            log.debug("Logged %s removed articles to %s", len(pending), removal_log)
+        except IOError:
+            log.error("Problem writing removed articles to %s", removal_log)
+
+    def load_removals(self) -> list:
+        '''
+            Reads titles removed in earlier runs from the removal log
+        '''
+        removal_log = get_settings().removal_log
+        try:
+            with open(removal_log, 'r') as log_file:
+                titles = [json.loads(line) for line in log_file if line.strip()]
+        except (IOError, ValueError):
+            log.debug("No removed articles loaded from %s", removal_log)
+            return []
+
+        with self.lock:
+            self.removed.update(titles)
+        log.debug("Loaded %s removed articles from %s", len(titles), removal_log)
+        return titles
+
+
+def test_article_store():
+    '''
+        Test function for ArticleStore, articles are deduplicated by URL,
+        the window is bounded by size and age and removed titles are skipped
+    '''
+    settings = get_settings()
+    now = time.time()
+
+    def article(number: int, hours_old: float = 0, **fields) -> Article:
+        # a higher number is published a little earlier
+        published = time.gmtime(now - hours_old * 60 * 60 - number)
+        return Article(title="Title %s" % number, url="https://example.com/%s" % number,
+            publishedAt=time.strftime('%Y-%m-%dT%H:%M:%SZ', published), **fields)
+
+    store = ArticleStore()
+    store.add([article(1), article(2)])
+    assert [each.title for each in store.window()] == ["Title 1", "Title 2"]
+
+    # the same URL again refreshes the article, it isn't added twice
+    version = store.version
+    store.add([article(1)])
+    assert len(store) == 2 and store.version == version
+    store.add([article(1, description="Updated")])
+    assert len(store) == 2 and store.version > version
+    assert store.window()[0].description == "Updated"
+
+    # articles older than news_max_age_hours are left out and expire
+    store.add([article(3, hours_old=settings.news_max_age_hours + 1)])
+    assert len(store) == 2
+    store.published["https://example.com/2"] = now - (settings.news_max_age_hours + 1) * 60 * 60
+    assert [each.title for each in store.window()] == ["Title 1"]
+
+    # removed titles are tombstoned and skipped by later updates
+    assert store.remove("Title 1")
+    assert not store.remove("Title 1")
+    store.flush_timer.cancel()
+    store.add([article(1)])
+    assert len(store) == 0
+
+    # removing a title removes every copy of it, whatever its URL
+    store.add([article(4), Article(title="Title 4", url="https://example.org/4",
+        publishedAt=article(4).publishedAt)])
+    assert len(store) == 2
+    assert store.remove("Title 4")
+    store.flush_timer.cancel()
+    assert store.window() == [] and store.titles == {}
+
+    # the oldest articles are evicted once the window is full
+    size = settings.news_window_size
+    store.add([article(number) for number in range(10, 10 + size + 3)])
+    assert [each.title for each in store.window()] == [
+        "Title %s" % number for number in range(10, 10 + size)]
+
+
+def published_timestamp(article: Article, default: float) -> float:
+    '''
+        Returns when an article was published in seconds since epoch,
+        or default if its publishedAt isn't a valid timestamp
+    '''
     try:
-        with open(config_file, 'r') as json_file:
-            json_data = json.loads(json_file.read())
-            config_api = json_data['apiKey']
-            apiKey = "&apiKey=" + config_api
-            news_csv = json_data['newsCSV']
-            logging.debug('Successfully read configuration file')
-    except IOError:
-        logging.error('Problem opening %s, '+
-            'check to make sure your configuration file is not missing.', config_file)
-        global config_error
-        config_error = True
+        return datetime.fromisoformat(article.publishedAt.replace('Z', '+00:00')).timestamp()
+    except (AttributeError, ValueError):
+        return default
 
-read_config()
 
-def news_API_request(covid_terms: str = "Covid COVID-19 coronavirus") -> dict:
+def write_news_csv(articles: list) -> None:
+    '''
+        Saves articles to the news CSV, meant to be run on a background thread
+    '''
+    news_csv = get_settings().news_csv
+    with news_csv_lock:
+        try:
+            with open(news_csv, 'w', newline='') as csv_output:
+                csv_writer = csv.writer(csv_output)
+                csv_writer.writerow(Article.__slots__)
+                csv_writer.writerows(article.to_row() for article in articles)
+            log.debug("Saved %s articles to %s", len(articles), news_csv)
+        except IOError:
+            log.error("Problem writing articles to %s", news_csv)
+
+
+def save_articles(articles: list) -> None:
+    '''
+        Persists articles off the request path if persistence is enabled
+        and the list differs from the one last saved
+    '''
+    global news_csv_articles
+    settings = get_settings()
+    if not settings.news_persist or not settings.news_csv or articles is news_csv_articles:
+        return
+    news_csv_articles = articles
+
+    task = threading.Thread(target=write_news_csv, args=(articles,))
+    task.daemon = True
+    task.start()
+
+
+def build_news_snapshot() -> dict:
+    '''
+        Returns the news window in the layout saved to news_snapshot
+    '''
+    refreshed_at = None
+    if news_refreshed_at is not None:
+        refreshed_at = news_refreshed_at + time.time() - time.monotonic()
+    return {'fields': Article.__slots__, 'refreshed_at': refreshed_at,
+        'articles': [article.to_row() for article in news_store.window()]}
+
+
+def load_news_snapshot() -> None:
+    '''
+        Fills news_store from news_snapshot, keeping the time it was last
+        refreshed so stale news is served while it is refreshed
+    '''
+    global news_refreshed_at
+    news_snapshot = get_settings().news_snapshot
+    if not news_snapshot:
+        return
+    json_data = read_snapshot(news_snapshot)
+    if json_data is None:
+        return
+
+    fields = json_data['fields']
+    news_store.add([Article(**dict(zip(fields, row))) for row in json_data['articles']])
+    if json_data['refreshed_at'] is not None:
+        news_refreshed_at = json_data['refreshed_at'] - time.time() + time.monotonic()
+    log.info("Loaded %s articles from %s", len(news_store), news_snapshot)
+
+news_store = ArticleStore()
+# removals from earlier runs are filtered out by news_store, not the query
+news_store.load_removals()
+news_snapshot_writer = SnapshotWriter(get_settings().news_snapshot, build_news_snapshot)
+
+
+def news_query_key(covid_terms: str, exclusions: list) -> tuple:
+    '''
+        Normalizes search terms and excluded titles into a cache key
+    '''
+    return (tuple(sorted(set(covid_terms.lower().split()))), tuple(sorted(set(exclusions))))
+
+
+def news_API_request(covid_terms: str = "Covid COVID-19 coronavirus",
+        refresh: bool = False) -> list:
     '''
         Takes in search terms separated by space delimiter,
-        gets the latest news with terms as query, converts results to a CSV file
+        gets the latest news with terms as query, returns a list of Articles.
+        Cached results are used within news_cache_ttl unless refresh is set
     '''
+    global news_refreshed_at
 
-    if config_error is False:
+    articles_list = []
+    settings = get_settings()
+    if config_loaded():
         # update global variable definition for use in between functions
         global gcovid_search
         gcovid_search = covid_terms
@@ -78,67 +407,89 @@ def news_API_request(covid_terms: str = "Covid COVID-19 coronavirus") -> dict:
         for i in range(1,len(keywords)):
             query = query + "+OR+" + keywords[i]
 
-        # concatenate query to exclude articles that have been removed
-        # only runs when list is not empty
-        if exclude_list != []:
-            query = query + "+NOT+" + exclude_list[0]
-            # loop through entire list, add every item to the query
-            for i in range(1,len(exclude_list)):
-                query = query + "+NOT+" + exclude_list[i]
+        # concatenate query to exclude the articles removed most recently,
+        # each title as an encoded phrase so the query stays short and valid
+        exclusions = exclude_list[-MAX_QUERY_EXCLUSIONS:]
+        for title in exclusions:
+            query = query + "+NOT+" + quote_plus('"%s"' % title.replace('"', ''))
 
         # build url
-        url = (everything_news_url + query + apiKey)
-
-        # get response from NewsAPI
-        response = requests.get(url)
-        logging.info("Successfully received a response from NewsAPI")
-
-        # process json file
-        response_json_string = json.dumps(response.json())
-        response_dict = json.loads(response_json_string)
-
+        url = (settings.news_url + query + "&apiKey=" + settings.api_key)
+
+        # the same search terms and exclusions always give the same results
+        key = news_query_key(covid_terms, exclusions)
+        with news_cache_lock:
+            entry = news_cache.get(key)
+
+        if (not refresh and entry is not None
+                and time.monotonic() - entry['fetched_at'] < settings.news_cache_ttl):
+            cache_result('news', 'hit')
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Using cached NewsAPI response for %s", covid_terms)
+        else:
+            cache_result('news', 'miss')
+            # conditional request, NewsAPI answers 304 if nothing has changed
+            headers = {}
+            if entry is not None and entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry is not None and entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+            # get response from NewsAPI
+            with timed('newsapi'):
+                response = news_session.get(url, headers=headers, timeout=NEWSAPI_TIMEOUT)
+                response.raise_for_status()
+
+            if response.status_code == 304:
+                log.info("NewsAPI results have not changed")
+                entry = dict(entry, fetched_at=time.monotonic())
+            else:
+                log.info("Successfully received a response from NewsAPI")
+                entry = {'articles': [Article.from_json(json_article)
+                        for json_article in response.json()['articles']],
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'fetched_at': time.monotonic()}
+            with news_cache_lock:
+                news_cache[key] = entry
 
         # get the articles only
-        articles_list = response_dict['articles']
-
-        # format and convert to CSV
-        df = pd.json_normalize(articles_list)
-        df.to_csv('covid_news.csv', header=True, index=True, index_label="index")
-
-        logging.info("Converted NewsAPI json to %s. End of news_API_request func", news_csv)
+        if news_refreshed_at != entry['fetched_at']:
+            news_store.add(entry['articles'])
+            news_refreshed_at = entry['fetched_at']
+            news_snapshot_writer.mark_dirty()
+        articles_list = news_store.window()
+        save_articles(entry['articles'])
+        log.info("Retrieved %s articles. End of news_API_request func", len(articles_list))
     else:
-        logging.error("Error reading configuration file")
+        log.error("Error reading configuration file")
 
     return articles_list
 
 
-def parse_news_csv() -> dict:
+@timed('parse_news_csv')
+def parse_news_csv() -> list:
     '''
-        Open CSV file of news articles and
-        return as a dictionary of articles
+        Open CSV file of news articles saved by save_articles and
+        return as a list of Articles
     '''
 
+    news_csv = get_settings().news_csv
     # open csv file in read mode
     try:
-        reader = csv.DictReader(open(news_csv, "r"))
-        logging.debug("Reading from %s", news_csv)
+        with open(news_csv, "r", newline='') as csv_file:
+            log.debug("Reading from %s", news_csv)
+            articles = [Article(**row) for row in csv.DictReader(csv_file)]
     except IOError:
-        logging.error("Error opening %s", news_csv)
-
-    # initialize dict and index
-    big_dict = {}
-    index = 0
+        log.error("Error opening %s", news_csv)
+        return []
 
-    # loop through the csv.DictReader
-    for index, i in enumerate(reader):
-        # assign each row to a big_dict to create a dictionary of dictionaries
-        big_dict[index] = i
+    log.info("Successfully read %s articles from %s", len(articles), news_csv)
+    return articles
 
-    logging.info("Successfully read %s to a dictionary", news_csv)
-    return big_dict
 
-
-def remove_article(title: str) -> dict:
+@timed('remove_article')
+def remove_article(title: str) -> bool:
     '''
         This function takes a news article title as and argument
         and removes it from the list of articles. Removed articles
@@ -146,163 +497,157 @@ def remove_article(title: str) -> dict:
     '''
     global exclude_list
 
+    log.debug("Removing article: %s", title)
+    removed = news_store.remove(title)
+
     # add argument to list of exclusions
-    exclude_list.append(title)
-    
-    # get data from news csv file
-    news_dict = parse_news_csv()
-    dict_size = len(news_dict)
+    if removed:
+        exclude_list.append(title)
+        news_snapshot_writer.mark_dirty()
+        log.info("Successfully removed %s", title)
 
-    # loop through dict to find title matches
-    logging.debug("Finding title matches to remove article. Searching for: %s" + title)
+    return removed
 
-    for i in range(0,dict_size):
-        if news_dict[i]['title'] == title:
-            del news_dict[i]
-            logging.info("Successfully deleted index %s, %s from list!", i, title)
 
-            # reassign dict size
-            dict_size = len(news_dict)
+def news_is_fresh(margin: float = 0) -> bool:
+    '''
+        Checks whether news_store was filled within news_cache_ttl,
+        and will still be in margin seconds
+    '''
+    return (news_refreshed_at is not None
+        and time.monotonic() - news_refreshed_at + margin < get_settings().news_cache_ttl)
 
-            # loop to fix indexes
-            logging.debug("Fixing indexes")
-            for j in range (i+1, dict_size+1):
-                current_index = int(news_dict[j]['index'])
-                news_dict[j]['index'] = current_index - 1
-            break
 
-    logging.info("Writing updated articles list to %s", news_csv)
-    list_of_dicts = []
-    for each in news_dict:
-        line = news_dict[each]
-        list_of_dicts.append(line)
+def update_news(refresh: bool = False) -> list:
+    '''
+        Calls all the necessary functions for a news update
+        Returns a list of Articles
+    '''
 
-    keys = list_of_dicts[0].keys()
+    log.info("Updating news")
+    articles = news_API_request(refresh=refresh)
+    log.info("Retrieved latest news")
+    return articles
 
-    with open(news_csv, 'w', newline='') as csv_output:
-        dict_writer = csv.DictWriter(csv_output, keys)
-        dict_writer.writeheader()
-        dict_writer.writerows(list_of_dicts)
-    logging.info("%s has been updated", news_csv)
 
-    return list_of_dicts
+def background_news_refresh() -> None:
+    '''
+        Target for the thread started by get_news
+    '''
+    try:
+        update_news()
+    except Exception:
+        log.error("Background news refresh failed, %s", traceback.format_exc())
+    finally:
+        news_refresh_lock.release()
 
 
-def update_news() -> dict:
+def get_news() -> list:
     '''
-        To be used with schedule_news_updates function,
-        Calls all the necessary functions for a news update
-        Returns data as a dictionary
+        Returns the news window for display. News is only fetched before
+        returning when the window is empty, stale news is returned
+        straight away while a background thread refreshes it
     '''
+    if len(news_store) == 0:
+        return update_news()
 
-    logging.info("Updating news")
-    news_API_request()
-    news_dict =  parse_news_csv()
-    logging.info("Retrieved latest news")
+    if not news_is_fresh() and news_refresh_lock.acquire(blocking=False):
+        task = threading.Thread(target=background_news_refresh)
+        task.daemon = True
+        task.start()
 
-    print("update_news function was ran at " + str(time.time()))
-    return news_dict
+    return news_store.window()
 
 
-def schedule_news_updates(update_interval, update_name: str, *repeat) -> None:
+def news_json(refresh: bool = True) -> tuple[bytes, str]:
     '''
-        This function accepts update_interval and update_name as argument,
-        Creates a thread to execute at the time provided to call for a news
-        update
+        Returns the news window serialised as JSON for the API, with a
+        strong ETag. The bytes are only rebuilt when the window changes.
+        If refresh is False, stale news is not refreshed
     '''
+    global news_json_cache
+    if refresh:
+        get_news()
+    cached = news_json_cache
+    # read the version first, a change while serialising only costs a rebuild
+    version = news_store.version
+    if cached is not None and cached[0] == version:
+        return cached[1], cached[2]
+
+    articles = [dict(zip(Article.__slots__, article.to_row()))
+        for article in news_store.window()]
+    body = json.dumps({'articles': articles}, separators=(",", ":")).encode()
+    etag = hashlib.sha1(body).hexdigest()
+    news_json_cache = (version, body, etag)
+    return body, etag
+
+
+def refresh_news() -> list:
+    '''
+        To be used with schedule_news_updates function,
+        Fetches the latest news and publishes it to news_store,
+        so pages are served warm
+    '''
+    return update_news(refresh=True)
 
-    global exclude_list
-    global threads
-    global news_sched_list
-
-    # process time from arguments and split it into 2 variables
-    logging.debug("Converting user time input (%s) to seconds since epoch", update_interval)
-    update_hours, update_minutes = map(int, update_interval.split(':'))
-
-    # calculate and get update time in seconds for the day
-    update_time_in_seconds = (update_hours * 60 * 60) + (update_minutes * 60)
-
-    # set up current date and time as variables for comparison
-    current_date_time = datetime.now()
-    temp_time = time.time()
 
-    # Get HH:MM time format from the current time
-    current_time = datetime.fromtimestamp(temp_time).strftime('%H:%M')
+def schedule_news_updates(update_interval: str, update_name: str, repeat: bool = False) -> None:
+    '''
+        This function accepts update_interval as HH:MM and update_name as
+        argument, Schedules a job to execute at the time provided to call
+        for a news update. If repeat is set, the update runs every day
+        at that time.
+    '''
 
-    # Split hours and minutes into 2 variables
-    curr_hours, curr_minutes = map(int, current_time.split(':'))
+    log.debug("Scheduling news update %s at %s, repeat: %s",
+        update_name, update_interval, repeat)
+    spec = DailyAt.parse(update_interval)
 
-    # Get current time in seconds since Epoch
-    curr_time_in_seconds = (curr_hours * 60 * 60) + (curr_minutes * 60)
+    # the job is registered with the scheduler under the update name
+    task = scheduler.schedule_daily(spec, refresh_news, update_name, group='news',
+        repeat=repeat)
 
-    # Check if time has past then sets the date accordingly
-    if curr_time_in_seconds < update_time_in_seconds:
-        day = current_date_time.day
-    else:
-        day = current_date_time.day + 1
+    log.debug("Sucessfully added %s to scheduler queue", task)
 
-    # Set update time into datetime type for processing
-    update_date_time = datetime(current_date_time.year, 
-        current_date_time.month, day, update_hours, update_minutes)
-    date_time_diff = update_date_time-current_date_time
-    time_diff_seconds = date_time_diff.total_seconds()
 
-    task = threading.Timer(time_diff_seconds, update_news)
-    task.daemon = True
-    task.start()
+def check_news_updates(displayed_updates_list: list) -> None:
+    '''
+        This function accepts updates_list as an argument and
+        looks up the state of each update's jobs in the scheduler
+        registry to check for jobs that have already been executed.
 
-    # store thread details in a list of dicts
-    temp = {'update_name':update_name, 'task':task}
-    news_sched_list.append(temp)
+        Remove executed jobs from updates_list
+    '''
 
-    logging.debug("Sucessfully added %s to threading queue", task)
+    expired = set()
+    for each in displayed_updates_list:
+        if scheduler.state(each['title'], 'news') in ('done', 'cancelled'):
+            expired.add(each['title'])
 
-    # recursive loop
-    if repeat is True:
-        # 1 day is added to the time
-        time_diff_seconds = time_diff_seconds + 86400
-        new_update_interval = datetime.fromtimestamp(time_diff_seconds).strftime('%c')
-        schedule_news_updates(new_update_interval, update_name, True)
+    # remove outdated updates in place
+    if expired:
+        displayed_updates_list[:] = [each for each in displayed_updates_list
+            if each['title'] not in expired]
+        log.debug("Removed finished news updates: %s", expired)
 
 
-def check_news_updates(displayed_updates_list: list) -> None:
+def settings_changed(old: Settings, new: Settings, changed: set) -> None:
     '''
-        This function accepts updates_list as an argument and
-        performs comparisons with the threading queue to check
-        for threads that have already been executed.
-
-        Remove executed threads from updates_list
-    '''
-
-    log.debug("Checking for expired updates")
-
-
-    global news_sched_list
-    del_index_list = []
-
-    # check if list is not empty then loop through it
-    if displayed_updates_list != []:
-        for index, each in enumerate(displayed_updates_list):
-            match = 0
-            name_search = each['title']
-            for line in news_sched_list:
-                # cross reference with thread dict from schedule_news_updates function
-                log.debug("Search key: %s, Current: %s", name_search, line['update_name'])
-                if name_search == line['update_name']:
-                    # look through thread queue to find matches
-                    for thread in threading.enumerate():
-                        log.debug(thread,line['task'])
-                        # thread hasn't been executed yet, removal not required
-                        if thread == line['task']:
-                            match += 1
-                    # no match = thread executed, add index to a list for removal
-                    if match == 0:
-                        del_index_list.append(index)
-
-        # remove outdated lists
-        for every in del_index_list:
-            del displayed_updates_list[every]
-    else:
-        log.debug("Updates list is empty")
-
-    log.debug("Returned updates list: %s", displayed_updates_list)
+        Reload listener, resets only what the changed settings affect
+    '''
+    global news_refreshed_at
+    if changed & {'api_key', 'news_url'}:
+        # cached responses came from another account or service
+        with news_cache_lock:
+            news_cache.clear()
+        news_refreshed_at = None
+    if changed & {'news_window_size', 'news_max_age_hours'}:
+        # adding nothing trims the window to the new limits
+        news_store.add([])
+        news_snapshot_writer.mark_dirty()
+    if 'news_snapshot' in changed:
+        news_snapshot_writer.filename = new.news_snapshot
+
+
+add_reload_listener(settings_changed)
+load_news_snapshot()
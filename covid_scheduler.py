@@ -0,0 +1,550 @@
+'''
+This module contains a scheduler that runs every scheduled update from a
+single thread, using a heap of due times and a small pool of workers
+'''
+import heapq
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from covid_settings import get_settings
+
+
+log = logging.getLogger(__name__)
+
+
+# job states that still count as scheduled
+ACTIVE_STATES = ('pending', 'running')
+# group of the app's own jobs, e.g. background refreshes. They share the
+# registry with user updates, so are left out unless asked for by group
+INTERNAL_GROUP = 'internal'
+
+
+class DailyAt:
+    '''
+        A time of day a job runs at, parsed from 'HH:MM'
+    '''
+
+    __slots__ = ('hour', 'minute')
+
+    def __init__(self, hour: int, minute: int) -> None:
+        self.hour = hour
+        self.minute = minute
+
+    def __repr__(self) -> str:
+        return "DailyAt('%02d:%02d')" % (self.hour, self.minute)
+
+    @classmethod
+    def parse(cls, update_time: str) -> 'DailyAt':
+        '''
+            Raises ValueError unless update_time is a valid 'HH:MM'
+        '''
+        try:
+            hour, minute = map(int, update_time.split(':'))
+        except (AttributeError, ValueError):
+            raise ValueError("Invalid update time %r" % update_time) from None
+        if not (0 <= hour < 24 and 0 <= minute < 60):
+            raise ValueError("Invalid update time %r" % update_time)
+        return cls(hour, minute)
+
+    def next_after(self, moment: datetime) -> datetime:
+        '''
+            Returns the first time after moment this spec is due
+        '''
+        due = moment.replace(hour=self.hour, minute=self.minute, second=0, microsecond=0)
+        if due <= moment:
+            due += timedelta(days=1)
+        return due
+
+
+class Job:
+    '''
+        A scheduled call of func, due at a time in seconds since epoch.
+        Jobs with an interval or a repeating DailyAt spec are put back on
+        the heap after each run.
+        The state is one of pending, running, done or cancelled, and
+        finished is set once the job is done or cancelled
+    '''
+
+    __slots__ = ('due', 'func', 'name', 'group', 'interval', 'spec', 'jitter', 'state', 'seq',
+        'finished')
+
+    def __init__(self, due: float, func, name: str, group: str, interval: float,
+            seq: int, spec: DailyAt = None, jitter: float = 0) -> None:
+        self.due = due
+        self.func = func
+        self.name = name
+        self.group = group
+        self.interval = interval
+        self.spec = spec
+        self.jitter = jitter
+        self.state = 'pending'
+        self.seq = seq
+        self.finished = threading.Event()
+
+    def __lt__(self, other: 'Job') -> bool:
+        return (self.due, self.seq) < (other.due, other.seq)
+
+    def __repr__(self) -> str:
+        return "Job(%r, %s)" % (self.name, self.state)
+
+
+class Scheduler:
+    '''
+        Keeps pending jobs in a heap ordered by due time. One thread sleeps
+        until the earliest job is due and hands it to the worker pool, so
+        the thread count stays the same however many jobs are scheduled.
+        Jobs are also registered by name and group so their state can be
+        looked up without searching the heap
+    '''
+
+    def __init__(self, max_workers: int = 2) -> None:
+        self.heap = []
+        # cancelled jobs still in the heap, see compact
+        self.cancelled = 0
+        # update name -> group -> list of jobs
+        self.registry = {}
+        # called with a job after each run and when it is cancelled
+        self.listeners = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.workers = ThreadPoolExecutor(max_workers=max_workers,
+            thread_name_prefix='scheduler-worker')
+        self.thread = None
+
+    def __len__(self) -> int:
+        '''
+            Returns the number of jobs waiting to run
+        '''
+        with self.condition:
+            return len(self.heap) - self.cancelled
+
+    def start(self) -> None:
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='scheduler')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def schedule(self, delay: float, func, name: str = None, interval: float = None,
+            group: str = None) -> Job:
+        '''
+            Schedules func to be called after delay seconds,
+            and then every interval seconds if interval is given
+        '''
+        job = Job(time.time() + delay, func, name, group, interval, next(self.counter))
+        return self.push(job)
+
+    def schedule_daily(self, spec: DailyAt, func, name: str = None, group: str = None,
+            repeat: bool = False, jitter: float = None) -> Job:
+        '''
+            Schedules func for the next time spec is due, and then every
+            day at that time if repeat is set. Each run is delayed by a
+            random amount of up to jitter seconds.
+        '''
+        if jitter is None:
+            jitter = get_settings().schedule_jitter
+        due = spec.next_after(datetime.now()).timestamp() + random.uniform(0, jitter)
+        job = Job(due, func, name, group, None, next(self.counter),
+            spec if repeat else None, jitter)
+        return self.push(job)
+
+    def push(self, job: Job) -> Job:
+        with self.condition:
+            heapq.heappush(self.heap, job)
+            self.registry.setdefault(job.name, {}).setdefault(job.group, []).append(job)
+            # wake the scheduler thread in case this job is now the earliest
+            self.condition.notify()
+        self.start()
+
+        log.debug("Scheduled %s in %.0f seconds", job, job.due - time.time())
+        return job
+
+    def next_due(self, job: Job, now: float) -> float:
+        '''
+            Returns when a repeating job is next due, always after now so a
+            job that ran late is not run again to catch up
+        '''
+        if job.spec is not None:
+            due = job.spec.next_after(datetime.fromtimestamp(now)).timestamp()
+        else:
+            due = job.due + job.interval
+            if due <= now:
+                due += (int((now - due) // job.interval) + 1) * job.interval
+        return due + random.uniform(0, job.jitter)
+
+    def cancel(self, job: Job) -> None:
+        '''
+            Cancels a job, it is dropped when it reaches the top of the heap
+            or when cancelled jobs make up most of the heap
+        '''
+        with self.condition:
+            if job.state not in ACTIVE_STATES:
+                return
+            # a running job finishes its current run but isn't re-armed
+            running = job.state == 'running'
+            job.state = 'cancelled'
+            if not running:
+                self.cancelled += 1
+                if self.cancelled > len(self.heap) // 2:
+                    self.compact()
+            self.condition.notify()
+        log.debug("Cancelled %s", job)
+        if not running:
+            self.notify(job)
+
+    def compact(self) -> None:
+        '''
+            Drops every cancelled job from the heap, callers hold the condition
+        '''
+        self.heap = [job for job in self.heap if job.state != 'cancelled']
+        heapq.heapify(self.heap)
+        self.cancelled = 0
+
+    def jobs(self, name: str, group: str = None) -> list:
+        '''
+            Returns the jobs registered under a name in one group, or in
+            every group but INTERNAL_GROUP. Callers hold the condition
+        '''
+        groups = self.registry.get(name, {})
+        if group is not None:
+            return list(groups.get(group, ()))
+        return [job for job_group, jobs in groups.items() if job_group != INTERNAL_GROUP
+            for job in jobs]
+
+    def cancel_name(self, name: str, group: str = None) -> int:
+        '''
+            Cancels every job registered under an update name, optionally
+            only those in one group. Returns the number of jobs cancelled
+        '''
+        with self.condition:
+            jobs = [job for job in self.jobs(name, group) if job.state in ACTIVE_STATES]
+        for job in jobs:
+            self.cancel(job)
+        return len(jobs)
+
+    def state(self, name: str, group: str = None) -> str:
+        '''
+            Returns the combined state of the jobs registered under an update
+            name, optionally only those in one group. Returns None if there
+            are no such jobs.
+        '''
+        with self.condition:
+            jobs = self.jobs(name, group)
+            if not jobs:
+                return None
+            states = {job.state for job in jobs}
+
+        for state in ('running', 'pending', 'done'):
+            if state in states:
+                return state
+        return 'cancelled'
+
+    def forget(self, name: str, group: str = None) -> None:
+        '''
+            Drops an update name from the registry once its jobs are
+            finished, optionally only the jobs in one group
+        '''
+        with self.condition:
+            groups = self.registry.get(name, {})
+            if any(job.state in ACTIVE_STATES for job in self.jobs(name, group)):
+                return
+            for job_group in list(groups):
+                if job_group == group or (group is None and job_group != INTERNAL_GROUP):
+                    del groups[job_group]
+            if not groups:
+                self.registry.pop(name, None)
+
+    def add_listener(self, callback) -> None:
+        self.listeners.append(callback)
+
+    def notify(self, job: Job) -> None:
+        '''
+            Notifies everyone waiting on a job that it has run or was
+            cancelled, finished is only set once it won't run again
+        '''
+        if job.state not in ACTIVE_STATES:
+            job.finished.set()
+        for callback in self.listeners:
+            try:
+                callback(job)
+            except Exception:
+                log.error("Scheduler listener failed for %s, %s", job, traceback.format_exc())
+
+    def run(self) -> None:
+        '''
+            Scheduler thread, waits for the earliest job and submits it
+        '''
+        while True:
+            with self.condition:
+                # drop cancelled jobs from the top of the heap
+                while self.heap and self.heap[0].state == 'cancelled':
+                    heapq.heappop(self.heap)
+                    self.cancelled -= 1
+
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+
+                job = self.heap[0]
+                delay = job.due - time.time()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+
+                heapq.heappop(self.heap)
+                job.state = 'running'
+
+            # a job far past its due time (e.g. after the machine slept) runs
+            # once, and repeating jobs are re-armed from now
+            if -delay > get_settings().misfire_grace:
+                log.warning("%s misfired by %.0f seconds, running it once", job, -delay)
+
+            self.workers.submit(self.execute, job)
+
+    def execute(self, job: Job) -> None:
+        '''
+            Runs a job on a worker thread and re-arms repeating jobs
+        '''
+        try:
+            job.func()
+        except Exception:
+            log.error("Scheduled job %s failed, %s", job, traceback.format_exc())
+
+        with self.condition:
+            if job.state != 'cancelled' and (job.interval or job.spec is not None):
+                job.due = self.next_due(job, time.time())
+                job.state = 'pending'
+                heapq.heappush(self.heap, job)
+                self.condition.notify()
+            elif job.state != 'cancelled':
+                job.state = 'done'
+        self.notify(job)
+
+
+class ScheduleStore:
+    '''
+        Keeps the scheduled updates in an append-only JSON log so they can
+        be restored after a restart. Each line records an update being
+        added, run or removed, and the log is compacted when it is loaded
+    '''
+
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def append(self, record: dict) -> None:
+        with self.lock:
+            try:
+                with open(self.filename, 'a') as log_file:
+                    log_file.write(json.dumps(record) + "\n")
+            except IOError:
+                log.error("Problem writing to schedule store %s", self.filename)
+
+    def add(self, name: str, update_time: str, repeat: bool, covid: bool, news: bool) -> None:
+        '''
+            Records a newly scheduled update
+        '''
+        entry = {'name': name, 'time': update_time, 'repeat': repeat, 'covid': covid,
+            'news': news, 'saved_at': time.time(), 'last_ran': None}
+        self.entries[name] = entry
+        self.append(dict(entry, op='add'))
+
+    def remove(self, name: str) -> None:
+        if self.entries.pop(name, None) is not None:
+            self.append({'op': 'remove', 'name': name})
+
+    def job_ran(self, job: Job) -> None:
+        '''
+            Scheduler listener, records runs and drops updates
+            that have no jobs left to run
+        '''
+        entry = self.entries.get(job.name)
+        if entry is None or job.group == INTERNAL_GROUP:
+            return
+        if job.state != 'cancelled':
+            entry['last_ran'] = time.time()
+            self.append({'op': 'ran', 'name': job.name, 'at': entry['last_ran']})
+        if scheduler.state(job.name) not in ACTIVE_STATES:
+            self.remove(job.name)
+
+    def load(self) -> tuple[list, list]:
+        '''
+            Replays and compacts the log. Returns the updates that should
+            be scheduled again and the updates that were due while the
+            app was not running
+        '''
+        entries = {}
+        try:
+            with open(self.filename, 'r') as log_file:
+                for line in log_file:
+                    try:
+                        record = json.loads(line)
+                        op = record.pop('op')
+                        name = record['name']
+                        if op == 'add':
+                            entries[name] = record
+                        elif op == 'ran' and name in entries:
+                            entries[name]['last_ran'] = record['at']
+                        elif op == 'remove':
+                            entries.pop(name, None)
+                    except (ValueError, KeyError, TypeError, AttributeError):
+                        # a partly written last line or a damaged record
+                        log.warning("Skipping unreadable record in %s: %r",
+                            self.filename, line.strip())
+        except IOError:
+            log.debug("No schedule store found at %s", self.filename)
+
+        now = datetime.now()
+        restored = []
+        missed = []
+        for entry in entries.values():
+            try:
+                spec = DailyAt.parse(entry['time'])
+                last_seen = datetime.fromtimestamp(entry['last_ran'] or entry['saved_at'])
+                if not (entry['covid'] or entry['news']):
+                    raise ValueError("no data to update")
+            except (ValueError, KeyError, TypeError, OverflowError, OSError) as error:
+                # dropped from the log when it is compacted below
+                log.warning("Dropping scheduled update %r from %s, %s",
+                    entry.get('name'), self.filename, error)
+                continue
+            if spec.next_after(last_seen) <= now:
+                missed.append(entry)
+                # the catch-up run stands in for the missed runs
+                entry['last_ran'] = now.timestamp()
+            # one-off updates that were missed are only covered by the catch-up
+            if entry['repeat'] or entry not in missed:
+                restored.append(entry)
+
+        self.entries = {entry['name']: entry for entry in restored}
+        with self.lock:
+            with open(self.filename, 'w') as log_file:
+                for entry in restored:
+                    log_file.write(json.dumps(dict(entry, op='add')) + "\n")
+
+        log.info("Restored %s scheduled updates, %s were missed", len(restored), len(missed))
+        return restored, missed
+
+
+scheduler = Scheduler()
+schedule_store = ScheduleStore(get_settings().schedule_store)
+scheduler.add_listener(schedule_store.job_ran)
+
+
+def test_next_after():
+    '''
+        Test function for DailyAt.next_after across day, month and year ends
+    '''
+    assert DailyAt(10, 0).next_after(datetime(2021, 10, 28, 9, 0)) == datetime(2021, 10, 28, 10, 0)
+    assert DailyAt(0, 30).next_after(datetime(2021, 1, 31, 23, 0)) == datetime(2021, 2, 1, 0, 30)
+    assert DailyAt(9, 15).next_after(datetime(2024, 2, 28, 9, 15)) == datetime(2024, 2, 29, 9, 15)
+    assert (DailyAt(23, 59).next_after(datetime(2021, 12, 31, 23, 59, 30))
+        == datetime(2022, 1, 1, 23, 59))
+    for update_time in ('24:00', '12:60', '12', '', 'noon', None):
+        try:
+            DailyAt.parse(update_time)
+        except ValueError:
+            continue
+        raise AssertionError("%r was accepted" % update_time)
+
+
+def test_next_due():
+    '''
+        Test function for Scheduler.next_due, a late interval job skips the
+        periods it missed and jitter only ever delays a run
+    '''
+    test_scheduler = Scheduler(max_workers=1)
+    now = time.time()
+    job = Job(now - 250, None, 'catch-up', None, 100, 0)
+    assert test_scheduler.next_due(job, now) == now + 50
+    job = Job(now + 10, None, 'on time', None, 100, 1, jitter=5)
+    for _ in range(20):
+        assert now + 110 <= test_scheduler.next_due(job, now) <= now + 115
+    job = Job(now, None, 'daily', None, None, 2, spec=DailyAt(0, 0))
+    midnight = DailyAt(0, 0).next_after(datetime.fromtimestamp(now)).timestamp()
+    assert test_scheduler.next_due(job, now) == midnight
+
+
+def test_rearm_after_run():
+    '''
+        Test function for Scheduler.execute, a repeating daily job is put back
+        on the heap for its next time and a one-off job is done
+    '''
+    test_scheduler = Scheduler(max_workers=1)
+    calls = []
+    spec = DailyAt.parse('00:00')
+    repeating = test_scheduler.schedule_daily(spec, lambda: calls.append(1), 'daily',
+        repeat=True, jitter=0)
+    one_off = test_scheduler.schedule_daily(spec, lambda: calls.append(2), 'once', jitter=0)
+    for job in (repeating, one_off):
+        job.state = 'running'
+        test_scheduler.execute(job)
+    assert calls == [1, 2]
+    assert repeating.state == 'pending' and repeating in test_scheduler.heap
+    assert repeating.due == spec.next_after(datetime.now()).timestamp()
+    assert one_off.state == 'done' and one_off.finished.is_set()
+    assert test_scheduler.state('daily') == 'pending'
+    assert test_scheduler.state('once') == 'done'
+
+
+def test_cancel_running_job():
+    '''
+        Test function for Scheduler.cancel, a job cancelled while it runs
+        finishes that run but is not re-armed
+    '''
+    test_scheduler = Scheduler(max_workers=1)
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_job():
+        started.set()
+        release.wait(5)
+    job = test_scheduler.schedule(0, slow_job, 'slow', interval=60)
+    assert started.wait(5)
+    assert test_scheduler.state('slow') == 'running'
+    assert test_scheduler.cancel_name('slow') == 1
+    assert not job.finished.is_set()
+    release.set()
+    assert job.finished.wait(5)
+    assert job.state == 'cancelled' and job not in test_scheduler.heap
+
+
+def test_cancelled_jobs_compacted():
+    '''
+        Test function for Scheduler.cancel, cancelled jobs aren't counted as
+        waiting and are dropped from the heap once they make up most of it
+    '''
+    test_scheduler = Scheduler(max_workers=1)
+    jobs = [test_scheduler.schedule(60 * 60, lambda: None, 'job%s' % number)
+        for number in range(4)]
+    assert len(test_scheduler) == 4
+    test_scheduler.cancel(jobs[0])
+    test_scheduler.cancel(jobs[1])
+    assert len(test_scheduler) == 2 and len(test_scheduler.heap) == 4
+    test_scheduler.cancel(jobs[2])
+    assert len(test_scheduler) == 1 and test_scheduler.heap == [jobs[3]]
+
+
+def test_misfired_job_runs_once():
+    '''
+        Test function for Scheduler.run, an interval job far past its due
+        time runs once and is re-armed after now
+    '''
+    test_scheduler = Scheduler(max_workers=1)
+    calls = []
+    ran = threading.Event()
+    now = time.time()
+    job = Job(now - 1000, lambda: (calls.append(1), ran.set()), 'late', None, 100, 0)
+    test_scheduler.push(job)
+    assert ran.wait(5)
+    time.sleep(0.1)
+    assert calls == [1]
+    assert job.state == 'pending' and job.due > now
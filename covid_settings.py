@@ -0,0 +1,350 @@
+'''
+This module loads covid_config.cfg into a single immutable Settings object
+shared by every module. Environment variables override the file, and the
+file is watched so changes are picked up without a restart: the new
+settings replace the old ones in one step and each module is told what
+changed, so it only resets the caches the change affects
+'''
+import dataclasses
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from types import MappingProxyType
+
+
+log = logging.getLogger(__name__)
+
+config_file = os.environ.get('COVID_CONFIG', 'covid_config.cfg')
+# prefix of the environment variables overriding settings, e.g. COVID_LOCATION
+ENV_PREFIX = 'COVID_'
+
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+
+
+class SettingsError(ValueError):
+    '''
+        Raised when the config file can't be read or holds an invalid value
+    '''
+
+
+def setting(key: str, default, minimum: float = None):
+    '''
+        Declares a Settings field read from key in the config file
+    '''
+    metadata = {'key': key, 'minimum': minimum}
+    if isinstance(default, dict):
+        # read-only, so a Settings object can't change after it is built
+        return field(default_factory=lambda: MappingProxyType(dict(default)), metadata=metadata)
+    return field(default=default, metadata=metadata)
+
+
+@dataclass(frozen=True)
+class Settings:
+    '''
+        Every configuration value of the app. Instances are never changed,
+        a reload builds a new one
+    '''
+    api_key: str = setting('apiKey', "")
+    image_path: str = setting('imagePath', "")
+    favicon_path: str = setting('faviconPath', "")
+    location: str = setting('location', "Exeter")
+    nation: str = setting('nation', "England")
+    areas: tuple = setting('areas', ())
+
+    # statistics
+    stats_cache_ttl: float = setting('statsCacheTTL', 300, minimum=0)
+    incomplete_days: int = setting('incompleteDays', 1, minimum=0)
+    incremental_sync: bool = setting('incrementalSync', True)
+    restated_days: int = setting('restatedDays', 5, minimum=0)
+    max_delta_days: int = setting('maxDeltaDays', 14, minimum=0)
+    csv_snapshot: bool = setting('covidCSVSnapshot', False)
+    area_fetch_workers: int = setting('areaFetchWorkers', 2, minimum=1)
+    max_api_requests: int = setting('maxAPIRequests', 2, minimum=1)
+    stats_snapshot: str = setting('statsSnapshot', "stats_snapshot.bin")
+    cov19_endpoint: str = setting('cov19Endpoint', "")
+
+    # news
+    news_csv: str = setting('newsCSV', "")
+    news_url: str = setting('newsURL', "https://newsapi.org/v2/everything")
+    news_cache_ttl: float = setting('newsCacheTTL', 300, minimum=0)
+    news_persist: bool = setting('newsPersist', True)
+    removal_log: str = setting('removalLog', "removed_articles.log")
+    removal_flush_delay: float = setting('removalFlushDelay', 2, minimum=0)
+    news_window_size: int = setting('newsWindowSize', 20, minimum=1)
+    news_max_age_hours: float = setting('newsMaxAgeHours', 72, minimum=0)
+    news_snapshot: str = setting('newsSnapshot', "news_snapshot.bin")
+
+    # scheduling
+    schedule_jitter: float = setting('scheduleJitter', 0, minimum=0)
+    misfire_grace: float = setting('misfireGrace', 300, minimum=0)
+    schedule_store: str = setting('scheduleStore', "schedule_store.log")
+    catch_up_delay: float = setting('catchUpDelay', 5, minimum=0)
+
+    # serving
+    fetch_timeouts: dict = setting('fetchTimeouts', {'local': 10, 'nation': 10, 'news': 10})
+    api_max_age: int = setting('apiMaxAge', 60, minimum=0)
+    page_compression: bool = setting('pageCompression', True)
+    event_poll_interval: float = setting('eventPollInterval', 1, minimum=0.05)
+    event_keepalive: float = setting('eventKeepalive', 15, minimum=1)
+
+    # logging and reloading
+    log_level: str = setting('logLevel', "INFO")
+    log_levels: dict = setting('logLevels', {})
+    config_poll_interval: float = setting('configPollInterval', 2, minimum=0.1)
+
+    def __post_init__(self) -> None:
+        for each in dataclasses.fields(self):
+            minimum = each.metadata['minimum']
+            if minimum is not None and getattr(self, each.name) < minimum:
+                raise SettingsError("%s must be at least %s" % (each.metadata['key'], minimum))
+        for level in (self.log_level, *self.log_levels.values()):
+            if level not in LOG_LEVELS:
+                raise SettingsError("unknown log level %s" % level)
+        for source in ('local', 'nation', 'news'):
+            if source not in self.fetch_timeouts:
+                raise SettingsError("fetchTimeouts has no timeout for %s" % source)
+
+    def changed(self, other: 'Settings') -> set:
+        '''
+            Returns the names of the fields that differ from other
+        '''
+        return {each.name for each in dataclasses.fields(self)
+            if getattr(self, each.name) != getattr(other, each.name)}
+
+
+def convert(each: dataclasses.Field, value, from_env: bool = False):
+    '''
+        Converts a value from the config file or an environment variable
+        to the type of the field it sets
+    '''
+    key = each.metadata['key']
+    kind = each.type
+    try:
+        if from_env and kind in (tuple, dict):
+            value = json.loads(value)
+        if kind is bool:
+            if from_env:
+                if value.lower() not in ('1', 'true', 'yes', 'on', '0', 'false', 'no', 'off'):
+                    raise ValueError(value)
+                return value.lower() in ('1', 'true', 'yes', 'on')
+            if not isinstance(value, bool):
+                raise ValueError(value)
+            return value
+        if kind is tuple:
+            if not isinstance(value, list):
+                raise ValueError(value)
+            return tuple(value)
+        if kind is dict:
+            if not isinstance(value, dict):
+                raise ValueError(value)
+            # fetchTimeouts may only list the sources it changes
+            return MappingProxyType(dict(each.default_factory(), **value))
+        if kind in (int, float) and isinstance(value, bool):
+            raise ValueError(value)
+        return kind(value)
+    except (TypeError, ValueError):
+        raise SettingsError("invalid value for %s: %r" % (key, value)) from None
+
+
+def load_settings(filename: str = None) -> Settings:
+    '''
+        Reads the config file and the environment overrides into Settings,
+        raises SettingsError if either can't be used
+    '''
+    filename = filename or config_file
+    try:
+        with open(filename, 'r') as json_file:
+            json_data = json.loads(json_file.read())
+    except IOError as error:
+        raise SettingsError("problem opening %s, %s" % (filename, error)) from None
+    except ValueError as error:
+        raise SettingsError("%s is not valid JSON, %s" % (filename, error)) from None
+    return settings_from(json_data, filename)
+
+
+def settings_from(json_data: dict, filename: str) -> Settings:
+    '''
+        Builds Settings from the parsed config file and the environment
+    '''
+    values = {}
+    fields = dataclasses.fields(Settings)
+    known = {each.metadata['key'] for each in fields}
+    for key in json_data.keys() - known:
+        log.warning("Unknown setting %s in %s", key, filename)
+
+    for each in fields:
+        key = each.metadata['key']
+        if key in json_data:
+            values[each.name] = convert(each, json_data[key])
+        env_value = os.environ.get(ENV_PREFIX + each.name.upper())
+        if env_value is not None:
+            values[each.name] = convert(each, env_value, from_env=True)
+    return Settings(**values)
+
+
+global settings
+settings = Settings()
+# whether settings came from a readable, valid config file
+global settings_loaded
+settings_loaded = False
+settings_lock = threading.Lock()
+reload_listeners = []
+
+try:
+    settings = load_settings()
+    settings_loaded = True
+except SettingsError as error:
+    log.error("%s, check to make sure your configuration file is set up correctly. "
+        "Using default settings", error)
+    try:
+        settings = settings_from({}, config_file)
+    except SettingsError as error:
+        log.error("Ignoring environment overrides, %s", error)
+
+
+def get_settings() -> Settings:
+    '''
+        Returns the current settings. Callers needing several values
+        should keep the returned object, so they all come from one version
+    '''
+    return settings
+
+
+def config_loaded() -> bool:
+    return settings_loaded
+
+
+def add_reload_listener(listener) -> None:
+    '''
+        Registers listener(old, new, changed) to be called after the settings
+        change, changed is the set of field names that differ
+    '''
+    reload_listeners.append(listener)
+
+
+def swap_settings(new_settings: Settings) -> bool:
+    '''
+        Replaces the current settings and tells the listeners what changed,
+        returns False if nothing did
+    '''
+    global settings
+    with settings_lock:
+        old_settings = settings
+        changed = new_settings.changed(old_settings)
+        if not changed:
+            return False
+        settings = new_settings
+
+    log.info("Settings changed: %s", ", ".join(sorted(changed)))
+    for listener in reload_listeners:
+        try:
+            listener(old_settings, new_settings, changed)
+        except Exception:
+            log.exception("Problem applying changed settings in %s", listener)
+    return True
+
+
+def reload_settings() -> bool:
+    '''
+        Reloads the config file, keeping the current settings if it is
+        invalid. Returns True if the settings changed
+    '''
+    global settings_loaded
+    try:
+        new_settings = load_settings()
+    except SettingsError as error:
+        log.error("Not reloading settings, %s", error)
+        return False
+    settings_loaded = True
+    return swap_settings(new_settings)
+
+
+def override_settings(**changes) -> bool:
+    '''
+        Replaces some settings without touching the config file,
+        e.g. override_settings(incremental_sync=False)
+    '''
+    return swap_settings(dataclasses.replace(settings, **changes))
+
+
+def config_file_state() -> tuple:
+    try:
+        stat = os.stat(config_file)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def watch_config() -> None:
+    '''
+        Polls the config file and reloads the settings when it changes
+    '''
+    state = config_file_state()
+    while True:
+        time.sleep(settings.config_poll_interval)
+        current_state = config_file_state()
+        if current_state != state and current_state is not None:
+            state = current_state
+            log.info("%s changed, reloading settings", config_file)
+            reload_settings()
+
+
+def start_config_watch() -> None:
+    watcher = threading.Thread(target=watch_config, name='config-watch')
+    watcher.daemon = True
+    watcher.start()
+
+
+def test_settings_from():
+    '''
+        Test function for settings_from, values from the config file and
+        the environment are converted and invalid values are rejected
+    '''
+    saved_env = {key: value for key, value in os.environ.items() if key.startswith(ENV_PREFIX)}
+    for key in saved_env:
+        del os.environ[key]
+    try:
+        settings = settings_from({'location': "Plymouth", 'areas': ["Exeter"],
+            'fetchTimeouts': {'news': 3}, 'newsPersist': False, 'statsCacheTTL': 60}, "test.cfg")
+        assert settings.location == "Plymouth" and settings.areas == ("Exeter",)
+        assert dict(settings.fetch_timeouts) == {'local': 10, 'nation': 10, 'news': 3}
+        assert settings.news_persist is False and settings.stats_cache_ttl == 60.0
+        assert settings.changed(Settings()) == {'location', 'areas', 'fetch_timeouts',
+            'news_persist', 'stats_cache_ttl'}
+
+        # settings can't be changed once built
+        for change in (lambda: setattr(settings, 'location', "Exeter"),
+                lambda: settings.fetch_timeouts.update(news=1)):
+            try:
+                change()
+            except (dataclasses.FrozenInstanceError, AttributeError, TypeError):
+                continue
+            raise AssertionError("settings were changed")
+
+        os.environ.update({'COVID_NEWS_PERSIST': "yes", 'COVID_AREAS': '["A", "B"]',
+            'COVID_API_MAX_AGE': "30", 'COVID_LOG_LEVELS': '{"covid_scheduler": "DEBUG"}'})
+        settings = settings_from({'newsPersist': False, 'apiMaxAge': 5}, "test.cfg")
+        assert settings.news_persist is True and settings.areas == ("A", "B")
+        assert settings.api_max_age == 30
+        assert dict(settings.log_levels) == {'covid_scheduler': "DEBUG"}
+
+        invalid = [({}, {'COVID_NEWS_PERSIST': "maybe"}), ({}, {'COVID_AREAS': "A"}),
+            ({'apiMaxAge': -1}, {}), ({'apiMaxAge': "soon"}, {}), ({'statsCacheTTL': True}, {}),
+            ({'newsPersist': "yes"}, {}), ({'areas': "Exeter"}, {}), ({'logLevel': "LOUD"}, {}),
+            ({'logLevels': {'covid_scheduler': "LOUD"}}, {}), ({'fetchTimeouts': [10]}, {})]
+        for json_data, env in invalid:
+            for key in [key for key in os.environ if key.startswith(ENV_PREFIX)]:
+                del os.environ[key]
+            os.environ.update(env)
+            try:
+                settings_from(json_data, "test.cfg")
+            except SettingsError:
+                continue
+            raise AssertionError("%r with %r was accepted" % (json_data, env))
+    finally:
+        for key in [key for key in os.environ if key.startswith(ENV_PREFIX)]:
+            del os.environ[key]
+        os.environ.update(saved_env)
@@ -0,0 +1,144 @@
+'''
+This module contains functions to save and load snapshots of the latest
+statistics and articles, so a restarted app can serve pages straight away
+'''
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+
+log = logging.getLogger(__name__)
+
+# file layout: magic, format version, payload length, payload crc32, payload
+SNAPSHOT_MAGIC = b'CVDSNAP\0'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('<8sHII')
+
+
+def write_snapshot(filename: str, data: dict) -> None:
+    '''
+        Saves data to a snapshot file. The file is written to a temporary
+        name first and swapped in, so readers never see half a snapshot
+    '''
+    payload = json.dumps(data, separators=(",", ":")).encode()
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(payload),
+        zlib.crc32(payload))
+
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, 'wb') as snapshot_file:
+        snapshot_file.write(header)
+        snapshot_file.write(payload)
+    os.replace(temp_filename, filename)
+    log.debug("Saved snapshot %s, %s bytes", filename, len(payload))
+
+
+def read_snapshot(filename: str) -> dict:
+    '''
+        Loads a snapshot file saved by write_snapshot, returns None if the
+        file is missing, from another format version or damaged
+    '''
+    try:
+        with open(filename, 'rb') as snapshot_file:
+            with mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if len(mapped) < SNAPSHOT_HEADER.size:
+                    raise ValueError("truncated header")
+                magic, version, length, checksum = SNAPSHOT_HEADER.unpack_from(mapped)
+                if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                    raise ValueError("unknown snapshot format")
+                payload = mapped[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + length]
+                if len(payload) != length or zlib.crc32(payload) != checksum:
+                    raise ValueError("damaged payload")
+    except (IOError, ValueError) as error:
+        log.debug("No snapshot loaded from %s, %s", filename, error)
+        return None
+
+    log.debug("Loaded snapshot %s", filename)
+    return json.loads(payload)
+
+
+class SnapshotWriter:
+    '''
+        Saves snapshots in the background. Changes are batched, so a burst
+        of updates causes one write after delay seconds
+    '''
+
+    def __init__(self, filename: str, build, delay: float = 1) -> None:
+        self.filename = filename
+        self.build = build
+        self.delay = delay
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def mark_dirty(self) -> None:
+        if not self.filename:
+            return
+        with self.lock:
+            if self.timer is None:
+                self.timer = threading.Timer(self.delay, self.write)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self) -> None:
+        '''
+            Writes a pending snapshot now instead of after the delay
+        '''
+        with self.lock:
+            timer = self.timer
+            self.timer = None
+        if timer is not None:
+            timer.cancel()
+            self.write()
+
+    def cancel(self) -> None:
+        '''
+            Drops a pending snapshot without writing it
+        '''
+        with self.lock:
+            timer = self.timer
+            self.timer = None
+        if timer is not None:
+            timer.cancel()
+
+    def write(self) -> None:
+        with self.lock:
+            self.timer = None
+        try:
+            write_snapshot(self.filename, self.build())
+        except Exception:
+            log.exception("Problem saving snapshot %s", self.filename)
+
+
+def test_read_snapshot():
+    '''
+        Test function for read_snapshot, damaged or foreign files are
+        rejected instead of loaded
+    '''
+    import tempfile
+    data = {'stats': [["Exeter", "ltla", [1, 2, 3], 1635400000.0]]}
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "snapshot.bin")
+        write_snapshot(filename, data)
+        assert read_snapshot(filename) == data
+        with open(filename, 'rb') as snapshot_file:
+            snapshot = snapshot_file.read()
+
+        flipped = bytearray(snapshot)
+        flipped[-2] ^= 0xFF
+        damaged = {
+            'empty': b"",
+            'truncated header': snapshot[:SNAPSHOT_HEADER.size - 1],
+            'truncated payload': snapshot[:-1],
+            'flipped byte': bytes(flipped),
+            'other magic': b"NOTSNAP\0" + snapshot[8:],
+            'other version': SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION + 1,
+                *SNAPSHOT_HEADER.unpack_from(snapshot)[2:]) + snapshot[SNAPSHOT_HEADER.size:],
+        }
+        for name, contents in damaged.items():
+            with open(filename, 'wb') as snapshot_file:
+                snapshot_file.write(contents)
+            assert read_snapshot(filename) is None, name
+        assert read_snapshot(os.path.join(directory, "missing.bin")) is None
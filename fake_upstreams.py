@@ -0,0 +1,194 @@
+'''
+A local stand-in for Cov19API and NewsAPI, for load testing without
+touching the real services or the NewsAPI quota. Latency, failure rate
+and payload sizes are configurable, and calls are counted per upstream.
+
+    python fake_upstreams.py --port 8089 --latency 0.2 --failure-rate 0.05
+
+then point the app at it in covid_config.cfg:
+
+    "cov19Endpoint": "http://127.0.0.1:8089/v1/data",
+    "newsURL": "http://127.0.0.1:8089/v2/everything",
+
+GET /stats returns the call counts as JSON, /stats?reset=1 also resets them.
+'''
+import argparse
+import json
+import random
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from benchmark import covid_rows, news_articles
+
+
+# rows per page of Cov19API results, as the real API pages them
+PAGE_SIZE = 1000
+
+
+class FakeUpstreams:
+    '''
+        Settings, payloads and call counts shared by the request handlers
+    '''
+
+    def __init__(self, latency: float = 0, jitter: float = 0, failure_rate: float = 0,
+            days: int = 600, articles: int = 100) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.days = days
+        self.articles = json.dumps({'status': "ok", 'totalResults': articles,
+            'articles': news_articles(articles)}).encode()
+        self.news_etag = '"articles-%s"' % articles
+        self.last_modified = formatdate(usegmt=True)
+        self.areas = {}
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def count(self, name: str) -> None:
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def stats(self, reset: bool = False) -> dict:
+        with self.lock:
+            calls = dict(self.calls)
+            if reset:
+                self.calls.clear()
+        return calls
+
+    def rows(self, area: str) -> list:
+        with self.lock:
+            rows = self.areas.get(area)
+            if rows is None:
+                rows = self.areas[area] = covid_rows(area, self.days, len(self.areas))
+        return rows
+
+    def delay(self) -> bool:
+        '''
+            Waits for the configured latency,
+            returns True if this call should fail
+        '''
+        latency = self.latency + random.uniform(-self.jitter, self.jitter)
+        if latency > 0:
+            time.sleep(latency)
+        return random.random() < self.failure_rate
+
+
+class FakeUpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    upstreams = None
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def send_body(self, status: int, body: bytes = b"", headers: dict = None) -> None:
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_HEAD(self) -> None:
+        self.do_GET()
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+        if url.path == '/stats':
+            calls = self.upstreams.stats(reset='reset' in params)
+            self.send_body(200, json.dumps(calls).encode(), {'Content-Type': "application/json"})
+        elif url.path == '/v1/data':
+            self.cov19(params)
+        elif url.path == '/v2/everything':
+            self.news()
+        else:
+            self.send_body(404)
+
+    def cov19(self, params: dict) -> None:
+        upstreams = self.upstreams
+        upstreams.count('cov19_' + self.command.lower())
+        if upstreams.delay():
+            upstreams.count('cov19_failed')
+            self.send_body(503)
+            return
+
+        filters = dict(each.split('=', 1) for each in params['filters'][0].split(';'))
+        headers = {'Last-Modified': upstreams.last_modified, 'Content-Type': "application/json"}
+        if self.command == 'HEAD':
+            self.send_body(200, headers=headers)
+            return
+
+        rows = upstreams.rows(filters.get('areaName', "England"))
+        if 'date' in filters:
+            rows = [row for row in rows if row['date'] == filters['date']]
+        page = int(params.get('page', ["1"])[0])
+        rows = rows[(page - 1) * PAGE_SIZE:page * PAGE_SIZE]
+        if not rows:
+            self.send_body(204, headers=headers)
+            return
+        self.send_body(200, json.dumps({'data': rows}).encode(), headers)
+
+    def news(self) -> None:
+        upstreams = self.upstreams
+        upstreams.count('news')
+        if upstreams.delay():
+            upstreams.count('news_failed')
+            self.send_body(503)
+            return
+        headers = {'ETag': upstreams.news_etag, 'Content-Type': "application/json"}
+        if self.headers.get('If-None-Match') == upstreams.news_etag:
+            self.send_body(304, headers=headers)
+            return
+        self.send_body(200, upstreams.articles, headers)
+
+
+def start_server(upstreams: FakeUpstreams, host: str = "127.0.0.1",
+        port: int = 0) -> ThreadingHTTPServer:
+    '''
+        Serves upstreams from a background thread, port 0 picks a free port
+    '''
+    handler = type('Handler', (FakeUpstreamHandler,), {'upstreams': upstreams})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='fake-upstreams')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--latency', type=float, default=0, help="seconds added to each call")
+    parser.add_argument('--jitter', type=float, default=0, help="random +/- seconds on the latency")
+    parser.add_argument('--failure-rate', type=float, default=0,
+        help="fraction of calls answered with 503")
+    parser.add_argument('--days', type=int, default=600, help="days of statistics per area")
+    parser.add_argument('--articles', type=int, default=100, help="articles per news response")
+
+
+def upstreams_from_args(args: argparse.Namespace) -> FakeUpstreams:
+    return FakeUpstreams(latency=args.latency, jitter=args.jitter,
+        failure_rate=args.failure_rate, days=args.days, articles=args.articles)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8089)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = start_server(upstreams_from_args(args), args.host, args.port)
+    print("Serving fake upstreams on http://%s:%s" % server.server_address[:2])
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
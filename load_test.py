@@ -0,0 +1,231 @@
+'''
+Load test for the dashboard. Drives main.app with concurrent requests while
+Cov19API and NewsAPI are served by the local stand-ins in fake_upstreams.py,
+and reports throughput, p50/p99 latency and upstream calls per page view.
+
+    python load_test.py --concurrency 16 --requests 2000 --latency 0.2
+    python load_test.py --paths / /api/news --failure-rate 0.1
+
+By default the app runs in this process against a fake upstream server it
+starts itself. To load a running server instead, start fake_upstreams.py,
+point the server's config at it, and pass both URLs:
+
+    python load_test.py --url http://127.0.0.1:5000 --upstream http://127.0.0.1:8089
+'''
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from fake_upstreams import add_arguments, start_server, upstreams_from_args
+
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# overrides applied to the copy of covid_config.cfg used by the load test
+LOAD_TEST_CONFIG = {
+    'apiKey': "loadtest",
+    'location': "Area 0",
+    'nation': "England",
+    'newsPersist': False,
+    'covidCSVSnapshot': False,
+    'statsSnapshot': "",
+    'newsSnapshot': "",
+    'logLevel': "WARNING",
+    'logLevels': {},
+}
+
+
+def percentile(values: list, fraction: float) -> float:
+    '''
+        Nearest-rank percentile of a sorted list
+    '''
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, round(fraction * len(values)) - 1))
+    return values[index]
+
+
+def latency_summary(latencies: list) -> dict:
+    latencies = sorted(latencies)
+    return {
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': (latencies[-1] if latencies else 0.0) * 1000,
+        'mean_ms': (statistics.fmean(latencies) if latencies else 0.0) * 1000,
+    }
+
+
+def in_process_client(app):
+    '''
+        Returns a function requesting a path from app, with a
+        test client per thread
+    '''
+    clients = threading.local()
+
+    def get(path: str) -> int:
+        client = getattr(clients, 'client', None)
+        if client is None:
+            client = clients.client = app.test_client()
+        response = client.get(path)
+        response.close()
+        return response.status_code
+    return get
+
+
+def http_client(base_url: str):
+    '''
+        Returns a function requesting a path from a running server
+    '''
+    def get(path: str) -> int:
+        try:
+            with urllib.request.urlopen(base_url + path) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as error:
+            return error.code
+    return get
+
+
+def run_load(get, paths: list, total: int, concurrency: int) -> dict:
+    '''
+        Sends total requests spread over paths from concurrency threads
+    '''
+    lock = threading.Lock()
+    next_request = [0]
+    latencies = {path: [] for path in paths}
+    statuses = {}
+
+    def worker() -> None:
+        while True:
+            with lock:
+                index = next_request[0]
+                next_request[0] += 1
+            if index >= total:
+                return
+            path = paths[index % len(paths)]
+            started = time.perf_counter()
+            try:
+                status = get(path)
+            except Exception as error:
+                status = type(error).__name__
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies[path].append(elapsed)
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - started
+
+    every_latency = [latency for path_latencies in latencies.values()
+        for latency in path_latencies]
+    return {
+        'requests': total,
+        'concurrency': concurrency,
+        'duration_s': duration,
+        'throughput_rps': total / duration if duration else 0.0,
+        'latency': latency_summary(every_latency),
+        'latency_by_path': {path: latency_summary(path_latencies)
+            for path, path_latencies in latencies.items()},
+        'statuses': statuses,
+    }
+
+
+def upstream_report(calls: dict, page_views: int) -> dict:
+    return {
+        'upstream_calls': calls,
+        'upstream_calls_per_view': {name: count / page_views for name, count in calls.items()},
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=500, help="requests to send")
+    parser.add_argument('--concurrency', type=int, default=8, help="concurrent clients")
+    parser.add_argument('--warmup', type=int, default=10,
+        help="requests sent before measuring, to fill the caches")
+    parser.add_argument('--paths', nargs='+', default=['/', '/index', '/api/news'],
+        help="paths requested in turn")
+    parser.add_argument('--url', help="load a running server instead of main.app in process")
+    parser.add_argument('--upstream', help="fake_upstreams.py server used by --url, for call counts")
+    parser.add_argument('-o', '--output', help="file to write the JSON report to")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    work_dir = None
+    if args.url:
+        get = http_client(args.url.rstrip('/'))
+
+        def upstream_calls(reset: bool = False) -> dict:
+            if not args.upstream:
+                return {}
+            stats_url = args.upstream.rstrip('/') + "/stats" + ("?reset=1" if reset else "")
+            with urllib.request.urlopen(stats_url) as response:
+                return json.loads(response.read())
+    else:
+        upstreams = upstreams_from_args(args)
+        server = start_server(upstreams)
+        upstream_url = "http://%s:%s" % server.server_address[:2]
+        upstream_calls = upstreams.stats
+
+        # the app reads its configuration and writes its stores in the working directory
+        work_dir = tempfile.mkdtemp(prefix="covid-load-")
+        with open(os.path.join(REPO_DIR, 'covid_config.cfg')) as config_file:
+            config = json.load(config_file)
+        config.update(LOAD_TEST_CONFIG)
+        config.update({'cov19Endpoint': upstream_url + "/v1/data",
+            'newsURL': upstream_url + "/v2/everything"})
+        with open(os.path.join(work_dir, 'covid_config.cfg'), 'w') as config_file:
+            json.dump(config, config_file, indent=4)
+        # relative paths given on the command line, e.g. --output, stay relative to here
+        start_dir = os.getcwd()
+        os.chdir(work_dir)
+        sys.path.insert(0, REPO_DIR)
+
+        import main as dashboard
+        dashboard.start_services()
+        get = in_process_client(dashboard.app)
+
+    try:
+        if args.warmup:
+            run_load(get, args.paths, args.warmup, 1)
+        upstream_calls(reset=True)
+        report = run_load(get, args.paths, args.requests, args.concurrency)
+        report.update(upstream_report(upstream_calls(), args.requests))
+    finally:
+        if work_dir is not None:
+            # stores are saved in the background, finish before the work dir goes
+            import covid_data_handler
+            for writer in list(covid_data_handler.covid_store_writers.values()):
+                writer.flush()
+            os.chdir(start_dir)
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report['upstream_settings'] = {'latency': args.latency, 'jitter': args.jitter,
+        'failure_rate': args.failure_rate, 'days': args.days, 'articles': args.articles}
+    print("%s requests, %s clients: %.1f req/s, p50 %.1f ms, p99 %.1f ms" % (
+        args.requests, args.concurrency, report['throughput_rps'],
+        report['latency']['p50_ms'], report['latency']['p99_ms']), file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
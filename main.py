@@ -1,119 +1,521 @@
 from re import template
-from flask import Flask, render_template, request, Markup
+from flask import Flask, render_template, request, Markup, abort, Response
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import gzip
+import hashlib
+import json
 import logging
-import sys
-
-from covid_data_handler import schedule_covid_updates, update_covid_data, check_covid_updates, remove_task
-from covid_news_handling import news_API_request, config_file, json, parse_news_csv, check_news_updates, remove_article, schedule_news_updates
+import threading
+import time
+import traceback
+
+from functools import partial
+from werkzeug.serving import is_running_from_reloader
+
+from covid_logging import setup_logging
+from covid_data_handler import schedule_covid_updates, update_covid_data, check_covid_updates, remove_task, covid_data_is_fresh, refresh_covid_data, stats_are_fresh, get_covid_stats, start_area_refresh, stats_json, current_stats_version, stats_json_changes
+from covid_news_handling import check_news_updates, remove_article, schedule_news_updates, get_news, news_store, news_is_fresh, refresh_news, news_json
+from covid_scheduler import ACTIVE_STATES, INTERNAL_GROUP, DailyAt, scheduler, schedule_store
+from covid_events import EventBroadcaster
+from covid_metrics import timed, add_timing, add_gauge, cache_result, start_request, end_request, render_metrics
+from covid_settings import Settings, add_reload_listener, config_loaded, get_settings, start_config_watch
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # set up logs
 log = logging.getLogger(__name__)
-FORMAT= '%(levelname)s: %(asctime)s %(message)s'
-logging.basicConfig(format=FORMAT, stream=sys.stdout, level=logging.DEBUG)
+setup_logging()
 
 # set up flask
 app = Flask(__name__, template_folder="templates")
 
-global config_error
-config_error = False
-global image_url
-image_url = "set_in_config"
-global favicon_url
-favicon_url = "set_in_config"
-global config_location
-config_location = "set_in_config"
-global config_nation
-config_nation = "set_in_config"
-
-global local_last7days_cases
-local_last7days_cases = 0
-global national_last7days_cases
-national_last7days_cases = 0
-global articles_list
-articles_list = []
-global national_hospital_cases
-national_hospital_cases = 0
-global national_deaths
-national_deaths = 0
 global updates_list
 updates_list = []
+global updates_version
+updates_version = 0
+global services_started
+services_started = False
+global live_updates_started
+live_updates_started = False
+services_lock = threading.Lock()
+# shortest time between background refreshes, however short the cache TTLs
+LIVE_REFRESH_MIN_INTERVAL = 10
+
+# shared pool for the upstream fetches made while serving a page
+fetch_pool = ThreadPoolExecutor(max_workers=len(get_settings().fetch_timeouts), thread_name_prefix='fetch')
+# last successful result of each fetch, served when a source is slow or failing
+last_good_data = {'local': (0, 0, 0), 'nation': (0, 0, 0), 'news': []}
+# rendered pages keyed by (page, data version), see render_page
+page_cache = {}
+page_cache_lock = threading.Lock()
+# pushes data changes to open pages, see publish_changes
+broadcaster = EventBroadcaster()
+
+# how to check each source is warm and how to get its data
+fetch_sources = {
+    'local': (partial(covid_data_is_fresh, "local"), partial(update_covid_data, "local")),
+    'nation': (partial(covid_data_is_fresh, "nation"), partial(update_covid_data, "nation")),
+    'news': (news_is_fresh, get_news),
+}
+
+def fetch_all(area: str = None) -> dict:
+    '''
+        Gets local statistics, national statistics and news articles.
+        Sources kept warm by scheduled updates are read straight from memory,
+        the others are fetched concurrently. A source that fails or takes
+        longer than its timeout falls back to its last good data so it can't
+        hold up the page. If area is given, local statistics are for that
+        area instead of the configured location.
+        Returns a dict of results keyed by source
+    '''
+    sources = dict(fetch_sources)
+    good_keys = {source: source for source in sources}
+    if area is not None:
+        sources['local'] = (partial(stats_are_fresh, area, 'ltla'),
+            partial(get_covid_stats, area, 'ltla'))
+        good_keys['local'] = ('local', area)
+
+    started = time.monotonic()
+    results = {}
+    futures = {}
+    for source, (is_fresh, fetch) in sources.items():
+        if is_fresh():
+            with timed('fetch_' + source):
+                results[source] = fetch()
+            last_good_data[good_keys[source]] = results[source]
+        else:
+            futures[source] = fetch_pool.submit(timed('fetch_' + source)(fetch))
+
+    fetch_timeouts = get_settings().fetch_timeouts
+    for source, future in futures.items():
+        remaining = fetch_timeouts[source] - (time.monotonic() - started)
+        try:
+            results[source] = future.result(timeout=max(remaining, 0))
+            add_timing('fetch_' + source, time.monotonic() - started)
+            last_good_data[good_keys[source]] = results[source]
+        except TimeoutError:
+            log.warning("Fetching %s timed out, using last good data", source)
+            results[source] = last_good_data.get(good_keys[source], (0, 0, 0))
+        except Exception:
+            log.error("Fetching %s failed, using last good data, %s", source,
+                traceback.format_exc())
+            results[source] = last_good_data.get(good_keys[source], (0, 0, 0))
+
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Fetched all sources in %.3fs", time.monotonic() - started)
+    return results
+
+def data_version() -> tuple:
+    '''
+        Returns a version that changes whenever the statistics,
+        news articles or updates_list shown on a page change
+    '''
+    return (current_stats_version(), news_store.version, updates_version)
 
-def read_config() -> None:
+def edit_updates(edit) -> None:
     '''
-        Open config file to read contents
+        Changes updates_list by calling edit with it while holding
+        page_cache_lock, so request and scheduler threads can't lose each
+        other's changes. updates_version is bumped if updates_list changed
     '''
-    
-    global image_url
-    global favicon_url
-    global config_location
-    global config_nation
-    try:
-        with open(config_file, 'r') as json_file:
-            json_data = json.loads(json_file.read())
-            image_url = json_data['imagePath']
-            favicon_url = json_data['faviconPath']
-            config_location = json_data['location']
-            config_nation = json_data['nation']
-            logging.debug('Successfully read configuration file')
-
-    except IOError:
-        logging.error('Problem opening %s, check to make sure your configuration file is not missing.'
-            , config_file)
-        global config_error
-        config_error = True
-
-read_config()
+    global updates_version
+    with page_cache_lock:
+        before = list(updates_list)
+        edit(updates_list)
+        if updates_list != before:
+            updates_version += 1
+
+def check_updates(updates: list) -> None:
+    '''
+        Drops the updates whose Covid or news jobs are finished
+    '''
+    check_covid_updates(updates)
+    check_news_updates(updates)
 
-@app.route('/')
-def home():
+def drop_update(name: str, updates: list) -> None:
     '''
-        Main function to populate HTML template with data, gets most recent Covid
-        statistics, process and then display them. Calls news_api_request function 
-        to get a list of news articles for display. 
+        Drops an update from updates by name
     '''
-    global local_covid_dict
-    global config_location
-    global config_nation
-    global articles_list
-    global local_last7days_cases
-    global national_last7days_cases
-    global national_hospital_cases
-    global national_deaths
-    global updates_list
+    updates[:] = [each for each in updates if each['title'] != name]
 
-    # detect config_error, without config, images can't be displayed
-    if config_error == True:
-        print("Error reading configuration file! Please make sure configuration file is set up correctly!")
-        exit()
+def render_page(page: str, version: tuple, **context):
+    '''
+        Renders index.html with context, reusing the rendered page and its
+        compressed variants until data_version changes. version must be
+        taken before the data in context is read, so a page is never
+        cached under a newer version than the data it shows. Clients
+        that already hold the current page get 304 Not Modified
+    '''
+    key = (page, version)
+    with page_cache_lock:
+        cached = page_cache.get(key)
 
-    local_last7days_cases, local_hospitalCases, local_total_deaths = update_covid_data("local")
-    national_last7days_cases, national_hospital_cases, national_deaths = update_covid_data("nation")
+    if cached is not None:
+        cache_result('page', 'hit')
+    else:
+        cache_result('page', 'miss')
+        with timed('render'):
+            body = render_template('index.html', **context).encode()
+        cached = {'identity': body, 'etag': hashlib.sha1(body).hexdigest()}
+        if get_settings().page_compression:
+            cached['gzip'] = gzip.compress(body)
+            if brotli is not None:
+                cached['br'] = brotli.compress(body)
+        with page_cache_lock:
+            # pages rendered for older data are never served again
+            for old_key in [old_key for old_key in page_cache if old_key[1] != key[1]]:
+                del page_cache[old_key]
+            page_cache[key] = cached
+
+    encoding = request.accept_encodings.best_match(
+        [encoding for encoding in ('br', 'gzip') if encoding in cached])
+    response = app.response_class(cached[encoding or 'identity'], mimetype='text/html')
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    # each encoding is a different representation, so needs its own strong ETag
+    response.set_etag(cached['etag'] if encoding is None else cached['etag'] + "-" + encoding)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+def render_home():
+    '''
+        Renders the dashboard for the configured location, reading the
+        statistics and news for every render instead of keeping copies
+    '''
+    version = data_version()
+    # get statistics and news updates concurrently
+    results = fetch_all()
+    local_last7days_cases, local_hospitalCases, local_total_deaths = results['local']
+    national_last7days_cases, national_hospital_cases, national_deaths = results['nation']
 
     ''' AYO WHY IN HTML HAVE BUT SO SNEAKY
     local_hospitalCases = "Hospital Cases: " + str(hospitalCases)
     local_total_deaths = "Total Deaths: " + str(total_deaths)'''
 
-    # get news updates
-    news_API_request()
-    articles_dict = parse_news_csv()
-
-    # put news articles in a list
-    for news in articles_dict:
-        line = articles_dict[news]
-        articles_list.append(line)
-
     # render index.html with params to populate the site with data
-    return render_template('index.html', title="Covid Updates",
-            favicon = favicon_url,
-            image = image_url, location = config_location,
+    settings = get_settings()
+    return render_page('home', version, title="Covid Updates",
+            favicon = settings.favicon_path,
+            image = settings.image_path, location = settings.location,
             local_7day_infections = local_last7days_cases,
-            nation_location = config_nation,
+            nation_location = settings.nation,
             national_7day_infections = national_last7days_cases,
-            news_articles = articles_list,
+            news_articles = news_store.window(),
             updates = updates_list,
             hospital_cases = national_hospital_cases,
             deaths_total = national_deaths)
 
+def add_update(update_time: str, label: str, repeat: bool, covid_data: bool,
+        news: bool) -> None:
+    '''
+        Adds an update to updates_list and schedules its jobs
+    '''
+    # store event details in a list to keep track of it
+    index_content = Markup(update_time + "<br>Repeat: " + str(repeat) + "<br>Covid Data Updates: "
+        + str(covid_data) + "<br>News updates: " + str(news))
+
+    line = {'title':label,'content':index_content}
+    edit_updates(lambda updates: updates.append(line))
+
+    if covid_data == True:
+        schedule_covid_updates(update_time, label, repeat)
+    if news == True:
+        schedule_news_updates(update_time, label, repeat)
+
+def catch_up(covid_data: bool, news: bool) -> None:
+    '''
+        Single background refresh standing in for every update
+        that was missed while the app was not running
+    '''
+    if covid_data:
+        refresh_covid_data("local")
+        refresh_covid_data("nation")
+    if news:
+        refresh_news()
+
+def restore_updates() -> None:
+    '''
+        Schedules the updates saved in the schedule store again and
+        coalesces the missed ones into one catch-up refresh
+    '''
+    restored, missed = schedule_store.load()
+    for entry in restored:
+        add_update(entry['time'], entry['name'], entry['repeat'], entry['covid'], entry['news'])
+
+    if missed:
+        covid_data = any(entry['covid'] for entry in missed)
+        news = any(entry['news'] for entry in missed)
+        log.info("Catching up on %s missed updates in the background", len(missed))
+        scheduler.schedule(get_settings().catch_up_delay, partial(catch_up, covid_data, news),
+            'catch-up', group=INTERNAL_GROUP)
+
+def live_refresh_interval() -> float:
+    '''
+        Seconds between background refreshes, the shorter cache TTL
+    '''
+    settings = get_settings()
+    return max(min(settings.stats_cache_ttl, settings.news_cache_ttl), LIVE_REFRESH_MIN_INTERVAL)
+
+def refresh_live_data() -> None:
+    '''
+        Keeps the configured location, nation and news warm for open pages,
+        which get the changes pushed to them instead of refreshing.
+        A source is refreshed if it would go stale before the next run
+    '''
+    interval = live_refresh_interval()
+    for loc_type in ("local", "nation"):
+        if not covid_data_is_fresh(loc_type, margin=interval):
+            try:
+                refresh_covid_data(loc_type)
+            except Exception:
+                log.error("Problem refreshing %s statistics, %s", loc_type, traceback.format_exc())
+    if not news_is_fresh(margin=interval):
+        try:
+            refresh_news()
+        except Exception:
+            log.error("Problem refreshing news, %s", traceback.format_exc())
+
+def start_live_refresh() -> None:
+    '''
+        Schedules refresh_live_data as a single interval job
+    '''
+    scheduler.schedule(0, refresh_live_data, 'live-refresh', interval=live_refresh_interval(),
+        group=INTERNAL_GROUP)
+
+def prune_updates(job) -> None:
+    '''
+        Scheduler listener, drops finished updates from updates_list as
+        soon as their jobs are done and pushes the change to open pages.
+        An update is dropped from the scheduler registry once none of its
+        jobs can run again, which may be after it left updates_list
+    '''
+    if job.group not in ('covid', 'news') or job.state in ACTIVE_STATES:
+        return
+    edit_updates(check_updates)
+    # forgotten only after check_updates has looked up its state
+    if scheduler.state(job.name) not in ACTIVE_STATES:
+        scheduler.forget(job.name)
+
+def publish_changes() -> None:
+    '''
+        The single producer for server-sent events. Watches data_version
+        and publishes what changed: the statistics of each location that
+        changed, the news window, or updates_list
+    '''
+    seen_etags = {}
+    stats_json_changes(seen_etags)
+    published = data_version()
+    while True:
+        time.sleep(get_settings().event_poll_interval)
+        version = data_version()
+        if version == published or len(broadcaster) == 0:
+            continue
+
+        try:
+            if version[0] != published[0]:
+                for body in stats_json_changes(seen_etags):
+                    broadcaster.publish('stats', body)
+            if version[1] != published[1]:
+                broadcaster.publish('news', news_json(refresh=False)[0])
+            if version[2] != published[2]:
+                with page_cache_lock:
+                    updates = [{'title': each['title'], 'content': str(each['content'])}
+                        for each in updates_list]
+                broadcaster.publish('updates', json.dumps(updates, separators=(",", ":")).encode())
+        except Exception:
+            log.error("Problem publishing changes, %s", traceback.format_exc())
+        published = version
+
+def start_event_producer() -> None:
+    '''
+        Starts the publish_changes thread
+    '''
+    producer = threading.Thread(target=publish_changes, name='events')
+    producer.daemon = True
+    producer.start()
+
+def start_live_updates() -> None:
+    '''
+        Starts the background refresh and the event producer that open pages
+        rely on instead of refreshing themselves. Called by start_services
+        and on every subscription to /events, so pages stay live however the
+        app is served. Calls after the first do nothing
+    '''
+    global live_updates_started
+    with services_lock:
+        if live_updates_started:
+            return
+        live_updates_started = True
+    start_live_refresh()
+    start_event_producer()
+
+def settings_changed(old: Settings, new: Settings, changed: set) -> None:
+    '''
+        Reload listener, drops rendered pages showing changed settings
+    '''
+    if changed & {'image_path', 'favicon_path', 'location', 'nation', 'page_compression'}:
+        with page_cache_lock:
+            page_cache.clear()
+    if changed & {'stats_cache_ttl', 'news_cache_ttl'} and live_updates_started:
+        scheduler.cancel_name('live-refresh', INTERNAL_GROUP)
+        scheduler.forget('live-refresh', INTERNAL_GROUP)
+        start_live_refresh()
+
+def start_services() -> None:
+    '''
+        Restores the saved updates and starts the background refreshes,
+        the event producer and the config watch. Only called by the process
+        serving requests, calls after the first do nothing
+    '''
+    global services_started
+    with services_lock:
+        if services_started:
+            return
+        services_started = True
+    restore_updates()
+    start_area_refresh()
+    start_live_updates()
+    start_config_watch()
+
+add_reload_listener(settings_changed)
+scheduler.add_listener(prune_updates)
+
+add_gauge('scheduler_queue_depth', "Jobs waiting in the scheduler queue", lambda: len(scheduler))
+add_gauge('event_clients', "Pages connected to the event stream", lambda: len(broadcaster))
+add_gauge('news_articles', "Articles in the news window", lambda: len(news_store))
+
+@app.before_request
+def start_timing():
+    start_request()
+
+@app.after_request
+def add_server_timing(response):
+    '''
+        Adds the time spent in each stage of this request as a Server-Timing header
+    '''
+    server_timing = end_request()
+    if server_timing is not None:
+        response.headers['Server-Timing'] = server_timing
+    return response
+
+@app.route('/')
+def home():
+    '''
+        Main function to populate HTML template with data, gets most recent Covid
+        statistics, process and then display them. Calls news_api_request function 
+        to get a list of news articles for display. 
+    '''
+    # without a valid config, images can't be displayed
+    if not config_loaded():
+        log.error("Error reading configuration file! Please make sure configuration file is set up correctly!")
+        abort(503)
+
+    # multi-area mode, e.g. /?area=Plymouth
+    area = request.args.get('area')
+    if area is not None:
+        return area_home(area)
+
+    return render_home()
+
+
+@app.route('/area/<area>')
+def area_home(area: str):
+    '''
+        Dashboard for one of the areas configured in multi-area mode, the
+        national statistics and news articles are shared by every area
+    '''
+    settings = get_settings()
+    if area not in settings.areas:
+        abort(404)
+
+    version = data_version()
+    results = fetch_all(area)
+    area_last7days_cases, area_hospital_cases, area_total_deaths = results['local']
+    area_national_last7days_cases, area_national_hospital_cases, area_national_deaths = results['nation']
+
+    return render_page('area/' + area, version, title="Covid Updates",
+            favicon = settings.favicon_path,
+            image = settings.image_path, location = area,
+            local_7day_infections = area_last7days_cases,
+            nation_location = settings.nation,
+            national_7day_infections = area_national_last7days_cases,
+            news_articles = news_store.window(),
+            updates = updates_list,
+            hospital_cases = area_national_hospital_cases,
+            deaths_total = area_national_deaths,
+            refresh_url = "/area/" + area)
+
+
+def json_response(body: bytes, etag: str):
+    '''
+        Serves pre-serialised JSON, answering with 304 Not Modified
+        when the client already holds the same ETag
+    '''
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = get_settings().api_max_age
+    return response.make_conditional(request)
+
+
+@app.route('/api/stats/<area>')
+def api_stats(area: str):
+    '''
+        Latest statistics for the configured location, nation or
+        one of the multi-area mode areas as JSON
+    '''
+    settings = get_settings()
+    if area == settings.nation:
+        location_type = 'nation'
+    elif area == settings.location or area in settings.areas:
+        location_type = 'ltla'
+    else:
+        abort(404)
+
+    try:
+        body, etag = stats_json(area, location_type)
+    except Exception:
+        log.error("Problem getting statistics for %s, %s", area, traceback.format_exc())
+        abort(503)
+    return json_response(body, etag)
+
+
+@app.route('/api/news')
+def api_news():
+    '''
+        Current news articles as JSON, newest first
+    '''
+    try:
+        body, etag = news_json()
+    except Exception:
+        log.error("Problem getting news articles, %s", traceback.format_exc())
+        abort(503)
+    return json_response(body, etag)
+
+
+@app.route('/events')
+def events():
+    '''
+        Server-sent event stream of data changes, replaces page refreshes
+    '''
+    start_live_updates()
+    response = Response(broadcaster.stream(get_settings().event_keepalive), mimetype='text/event-stream')
+    response.cache_control.no_cache = True
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route('/metrics')
+def metrics():
+    '''
+        Stage timings, counters and gauges in the Prometheus text format
+    '''
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
 
 @app.route('/index', methods=['GET'])
 def parse_url():
@@ -121,17 +523,6 @@ def parse_url():
         Gets all the parameters from the URL and processes it to schedule data
         and for news updates
     '''
-    global articles_list
-    global local_last7days_cases
-    global national_last7days_cases
-    global national_hospital_cases
-    global national_deaths
-
-    # if the user's first landing is at the /index page,
-    # redirect to home() function
-    if articles_list == []:
-        home()
-
     # get all arguments from url
     time = request.args.get('update')
     label = request.args.get('two')
@@ -157,71 +548,42 @@ def parse_url():
     else:
         news = False
 
-    # handles when there are no ticked boxes
-    if repeat == False and covid_data == False and news == False:
+    # handles when an update is submitted with no ticked boxes,
+    # repeat on its own would schedule no jobs
+    if (time != None or label != None) and covid_data == False and news == False:
         log.warning("No boxes ticked!")
-        exit()
+        time = None
+        label = None
 
-    # get task status
-    log.debug("printing updates_list ")
+    # check the time before anything is saved, a bad one would stop restarts
+    if time != None and label != None:
+        try:
+            DailyAt.parse(time)
+        except ValueError:
+            log.warning("Invalid update time %r for %s", time, label)
+            abort(400)
 
     # check for outdated scheds
-    check_covid_updates(updates_list)
-    check_news_updates(updates_list)
-
-    # update page with data after automatic page refreshes
-    if (repeat == False and covid_data == False and news == False and time == None 
-        and label == None and notif == None and update_item == None):
-
-        log.debug("Getting data updates")
-        # get local and national COVID 19 statistics
-        local_last7days_cases, local_hospitalCases, local_total_deaths = update_covid_data("local")
-        national_last7days_cases, national_hospital_cases, national_deaths = update_covid_data("nation")
-
-        # get news updates
-        news_API_request()
-        articles_dict = parse_news_csv()
-
-        # put news articles in a list
-        for each_news in articles_dict:
-            line = articles_dict[each_news]
-            articles_list.append(line)
+    edit_updates(check_updates)
 
     if time != None and label != None:
-        # store event details in a list to keep track of it
-        index_content = Markup(time + "<br>Repeat: " + str(repeat) + "<br>Covid Data Updates: "
-            + str(covid_data) + "<br>News updates: " + str(news))
-
-        line = {'title':label,'content':index_content}
-        updates_list.append(line)
-
-        if covid_data == True:
-            schedule_covid_updates(time, label, repeat)
-        if news == True:
-            schedule_news_updates(time, label, repeat)
-
-    log.debug(" updates list: %s", updates_list)
+        schedule_store.add(label, time, repeat, covid_data, news)
+        add_update(time, label, repeat, covid_data, news)
 
     if notif != None:
         log.debug("Calling remove_article func, key: %s", notif)
-        articles_list = remove_article(notif)
+        remove_article(notif)
 
     if update_item != None:
         log.debug("Calling remove_task func, key: %s", update_item)
         remove_task(update_item)
-        print("lmao")
+        edit_updates(partial(drop_update, update_item))
 
-    # render index.html with params to populate the site with data
-    return render_template('index.html', title="Covid Updates",
-            favicon = favicon_url,
-            image = image_url, location = config_location,
-            local_7day_infections = local_last7days_cases,
-            nation_location = config_nation,
-            national_7day_infections = national_last7days_cases,
-            news_articles = articles_list,
-            updates = updates_list,
-            hospital_cases = national_hospital_cases,
-            deaths_total = national_deaths)
+    return render_home()
 
 if __name__ == '__main__':
+    # the reloader runs this file in a parent process that only restarts
+    # the server, so background services only start in the serving child
+    if is_running_from_reloader():
+        start_services()
     app.run(debug=True)